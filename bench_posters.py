@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+# ==============================================================================
+# 🖼️ POSTER PIPELINE BENCHMARK
+# ==============================================================================
+# Renders a fixture set through watermark_poster() and reports per-stage timings
+# (decode, face_detect, gradient, composite, encode), peak memory and output bytes.
+# Memory is measured per case in a fresh subprocess, outside the timed runs. Synthetic fixtures come with and without faces (faces sit in the badge band,
+# so the collision/relocation path runs). Never touches the network: the font and
+# cascade are used from disk (or OpenCV's bundled cascade) and skipped otherwise.
+#
+#   python bench_posters.py                           # synthetic fixtures
+#   python bench_posters.py --fixtures ./posters      # add real posters (*face* = has faces)
+#   python bench_posters.py --save-baseline bench_baseline.json
+#   python bench_posters.py --compare bench_baseline.json --tolerance 0.15
+# ==============================================================================
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import subprocess
+import statistics
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+# main.py reads these at import time; the benchmark never talks to Telegram or MongoDB
+for key, value in {"API_ID": "0", "API_HASH": "bench", "BOT_TOKEN": "0:bench",
+                   "DATABASE_URI": "mongodb://localhost:27017"}.items():
+    os.environ.setdefault(key, value)
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+import main
+
+STAGES = ["decode", "face_detect", "gradient", "composite", "encode"]
+SIZES = [(500, 750), (1280, 1920), (2000, 3000)]
+BADGES = [None, "4K HDR"]
+WATERMARKS = [None, "@MovieChannel"]
+
+# ==============================================================================
+# OFFLINE ASSETS
+# ==============================================================================
+
+def use_local_assets():
+    # Replace main's downloaders so nothing is fetched: files on disk or nothing
+    cascade = "haarcascade_frontalface_default.xml"
+    if not os.path.exists(cascade):
+        bundled_dir = getattr(getattr(cv2, "data", None), "haarcascades", "")
+        cascade = os.path.join(bundled_dir, cascade) if bundled_dir else None
+        if cascade and not os.path.exists(cascade):
+            cascade = None
+    font = "HindSiliguri-Bold.ttf" if os.path.exists("HindSiliguri-Bold.ttf") else None
+    main.download_cascade = lambda: cascade
+    main.download_font = lambda: font
+    return {"cascade": bool(cascade), "font": bool(font)}
+
+# ==============================================================================
+# MEMORY
+# ==============================================================================
+
+def proc_status_kb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise OSError(f"{field} not in /proc/self/status")
+
+def reset_peak_rss():
+    # Linux: "5" resets the high-water mark to the current RSS, so the peak covers the render
+    # alone rather than the imports (which peak higher than a render on their own)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return proc_status_kb("VmRSS")
+    except OSError:
+        return None
+
+def peak_rss_kb():
+    try:
+        return proc_status_kb("VmHWM")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == "darwin" else peak   # bytes on macOS, KB elsewhere
+
+def peak_child():
+    # Child side of measure_peak(): one render in a fresh interpreter
+    badge, watermark = (json.loads(arg) for arg in sys.argv[2:4])
+    data = sys.stdin.buffer.read()
+    use_local_assets()
+    main.warm_render_assets()
+    base = reset_peak_rss()
+    buffer, error = main.watermark_poster(io.BytesIO(data), watermark, badge)
+    if not buffer:
+        raise SystemExit(f"Render failed: {error}")
+    print(json.dumps({"base_kb": base, "peak_kb": peak_rss_kb()}))
+
+def measure_peak(data, badge, watermark):
+    # Each case gets its own process, so the allocator state left by earlier cases can't hide
+    # (or inflate) this one; returns the process peak and the part of it the render added
+    # (None where the peak can't be reset and only the lifetime peak is known)
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--peak-child", json.dumps(badge), json.dumps(watermark)],
+        input=data, capture_output=True, check=True,
+    )
+    child = json.loads(proc.stdout.decode().strip().splitlines()[-1])
+    if child["base_kb"] is None:
+        return child["peak_kb"], None
+    return child["peak_kb"], child["peak_kb"] - child["base_kb"]
+
+# ==============================================================================
+# FIXTURES
+# ==============================================================================
+
+def draw_face(draw, cx, cy, w):
+    # Simple frontal face (skin oval, dark eyes/brows, nose shadow, mouth) the Haar cascade picks up
+    h = int(w * 1.3)
+    draw.ellipse((cx - w // 2, cy - h // 2, cx + w // 2, cy + h // 2), fill=(205, 160, 130))
+    ey, ex, er = cy - h * 0.12, w * 0.2, w * 0.09
+    for side in (-1, 1):
+        draw.ellipse((cx + side * ex - er * 1.4, ey - er, cx + side * ex + er * 1.4, ey + er), fill=(40, 30, 30))
+        draw.rectangle((cx + side * ex - er * 1.8, ey - er * 2.6, cx + side * ex + er * 1.8, ey - er * 1.9), fill=(60, 40, 30))
+    draw.polygon([(cx, ey + er), (cx - w * 0.07, cy + h * 0.12), (cx + w * 0.07, cy + h * 0.12)], fill=(170, 120, 95))
+    draw.ellipse((cx - w * 0.18, cy + h * 0.22, cx + w * 0.18, cy + h * 0.3), fill=(120, 50, 50))
+    draw.rectangle((cx - w // 2, cy - h // 2, cx + w // 2, cy - h // 2 + h * 0.12), fill=(50, 35, 25))
+
+def synthetic_poster(width, height, seed, faces=False):
+    # Deterministic poster-like image: vertical gradient, a few shapes, light noise,
+    # optionally one face in the badge band at the top and one lower down
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 1, height)[:, None, None]
+    top = rng.integers(0, 255, 3)
+    bottom = rng.integers(0, 255, 3)
+    pixels = (top * (1 - ramp) + bottom * ramp).repeat(width, axis=1)
+    pixels += rng.normal(0, 12, pixels.shape)
+    img = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        x1, y1 = x0 + int(rng.integers(20, width // 2)), y0 + int(rng.integers(20, height // 3))
+        draw.ellipse((x0, y0, x1, y1), fill=tuple(int(c) for c in rng.integers(0, 255, 3)))
+    if faces:
+        draw_face(draw, width // 2, int(height * 0.12), int(width * 0.22))
+        draw_face(draw, int(width * 0.2), int(height * 0.5), int(width * 0.2))
+        img = img.filter(ImageFilter.GaussianBlur(width / 250))
+    buffer = io.BytesIO()
+    img.save(buffer, "JPEG", quality=92)
+    return buffer.getvalue()
+
+def load_fixtures(fixture_dir=None):
+    fixtures = []
+    for i, (w, h) in enumerate(SIZES):
+        fixtures.append({"name": f"synthetic_{w}x{h}", "faces": False, "data": synthetic_poster(w, h, seed=i)})
+        fixtures.append({"name": f"synthetic_face_{w}x{h}", "faces": True, "data": synthetic_poster(w, h, seed=i, faces=True)})
+    if fixture_dir:
+        for name in sorted(os.listdir(fixture_dir)):
+            if name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
+                with open(os.path.join(fixture_dir, name), "rb") as f:
+                    fixtures.append({"name": os.path.splitext(name)[0], "faces": "face" in name.lower(), "data": f.read()})
+    return fixtures
+
+# ==============================================================================
+# RUNNER
+# ==============================================================================
+
+def run_case(data, badge, watermark, repeat, memory=True):
+    runs = []
+    out_bytes = 0
+    faces = 0
+    for _ in range(repeat):
+        timings = {}
+        started = time.perf_counter()
+        buffer, error = main.watermark_poster(io.BytesIO(data), watermark, badge, timings=timings)
+        total = time.perf_counter() - started
+        if not buffer:
+            raise RuntimeError(f"Render failed: {error}")
+        out_bytes = buffer.getbuffer().nbytes
+        faces = timings.pop("faces", 0)
+        timings["total"] = total
+        runs.append(timings)
+
+    peak_kb, render_kb = measure_peak(data, badge, watermark) if memory else (0, 0)
+    result = {"ms": {}, "peak_kb": peak_kb, "render_kb": render_kb, "output_bytes": out_bytes, "faces": faces}
+    for stage in STAGES + ["total"]:
+        values = [r.get(stage, 0.0) for r in runs]
+        result["ms"][stage] = round(statistics.median(values) * 1000, 3)
+    return result
+
+def run_suite(fixtures, repeat, memory=True):
+    results = {}
+    for fx in fixtures:
+        for badge in BADGES:
+            for watermark in WATERMARKS:
+                case = f"{fx['name']}|badge={'yes' if badge else 'no'}|wm={'yes' if watermark else 'no'}"
+                results[case] = run_case(fx["data"], badge, watermark, repeat, memory)
+                results[case]["expects_faces"] = fx["faces"]
+    return results
+
+def print_report(results):
+    header = f"{'case':<48}" + "".join(f"{s:>12}" for s in STAGES + ["total"]) + f"{'peak KB':>10}{'+render KB':>12}{'out KB':>9}{'faces':>7}"
+    print(header)
+    print("-" * len(header))
+    for case, r in results.items():
+        row = f"{case:<48}" + "".join(f"{r['ms'][s]:>12.2f}" for s in STAGES + ["total"])
+        print(row + f"{r['peak_kb']:>10}{r['render_kb'] if r['render_kb'] is not None else '-':>12}{r['output_bytes'] // 1024:>9}{r['faces']:>7}")
+
+def compare(results, baseline, tolerance):
+    # A stage regresses when it is slower than baseline by more than tolerance (and >= 1 ms)
+    regressions = []
+    for case, r in results.items():
+        base = baseline.get("results", {}).get(case)
+        if not base:
+            continue
+        for stage in STAGES + ["total"]:
+            old, new = base["ms"].get(stage, 0.0), r["ms"][stage]
+            if new - old >= 1.0 and new > old * (1 + tolerance):
+                regressions.append(f"{case} {stage}: {old:.2f} ms -> {new:.2f} ms")
+        if r["output_bytes"] > base["output_bytes"] * (1 + tolerance):
+            regressions.append(f"{case} output: {base['output_bytes']} B -> {r['output_bytes']} B")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the poster render pipeline.")
+    parser.add_argument("--fixtures", help="Directory with extra poster images (name them *face* if they contain faces)")
+    parser.add_argument("--repeat", type=int, default=5, help="Renders per case (median is reported)")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write results as a new baseline")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a stored baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown ratio in compare mode")
+    parser.add_argument("--json", metavar="PATH", help="Also write raw results as JSON")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the per-case peak memory subprocesses")
+    args = parser.parse_args()
+
+    assets = use_local_assets()
+    if not main.get_face_cascade():
+        print("⚠️ Haar cascade not available: face_detect timings will be 0.")
+    if not assets["font"]:
+        print("⚠️ HindSiliguri-Bold.ttf not found: text is drawn with Pillow's default font.")
+    memory = not args.no_memory and resource is not None
+    if not args.no_memory and resource is None:
+        print("⚠️ resource module not available: memory columns will be 0.")
+    main.warm_render_assets()
+
+    results = run_suite(load_fixtures(args.fixtures), args.repeat, memory)
+    print_report(results)
+    if assets["cascade"]:
+        missed = sorted({case.split("|")[0] for case, r in results.items() if r["expects_faces"] and "badge=yes" in case and not r["faces"]})
+        if missed:
+            print(f"\n⚠️ No faces detected in face fixtures: {', '.join(missed)}")
+
+    meta = {
+        "render_version": main.RENDER_VERSION,
+        "face_quality": main.FACE_DETECT_QUALITY,
+        "format": main.POSTER_FORMAT,
+        "quality": main.POSTER_QUALITY,
+        "max_side": main.POSTER_MAX_SIDE,
+        "assets": assets,
+    }
+    payload = {"meta": meta, "results": results}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2)
+        print(f"\n✅ Baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("meta") != meta:
+            print(f"\nℹ️ Settings differ from baseline: {baseline.get('meta')} vs {meta}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("\n❌ Regressions:")
+            for line in regressions:
+                print(f"  • {line}")
+            sys.exit(1)
+        print("\n✅ No regressions against baseline.")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--peak-child"]:
+        peak_child()
+    else:
+        main_cli()
@@ -26,20 +26,39 @@ import asyncio
 import logging
 import secrets
 import string
+import unicodedata
 import time
 import json
+import hashlib
+import gzip
+import shutil
+import tempfile
+import copy
+import random
+import threading
+import multiprocessing
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from threading import Thread
-from datetime import datetime
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from collections import OrderedDict
 
 # --- Third-party Library Imports ---
 import requests
+import aiohttp
 from PIL import Image, ImageDraw, ImageFont
-from pyrogram import Client, filters, enums
+from pyrogram import Client, filters, enums, idle
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
 from pyrogram.errors import UserNotParticipant, FloodWait, MessageNotModified
 from flask import Flask
 from dotenv import load_dotenv
 import motor.motor_asyncio
+from pymongo import UpdateOne, ReplaceOne
+from bson import json_util
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 import numpy as np
 import cv2 
 
@@ -55,6 +74,99 @@ API_HASH = os.getenv("API_HASH")
 
 # External APIs
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
+TMDB_BASE_URL = "https://api.themoviedb.org/3"
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+# Extra data embedded in the details call (e.g. "videos,external_ids,images")
+TMDB_DETAILS_APPEND = os.getenv("TMDB_DETAILS_APPEND", "videos,external_ids")
+TMDB_POSTER_BASE = "https://image.tmdb.org/t/p/w500"
+
+# User profile cache (read-through, dropped on every write through update_user)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "5000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600"))
+# URL Shortener Caches
+SHORT_LINK_CACHE_SIZE = int(os.getenv("SHORT_LINK_CACHE_SIZE", "5000"))
+SHORT_LINK_CACHE_TTL = int(os.getenv("SHORT_LINK_CACHE_TTL", "86400"))
+# Shortener circuit breaker (per domain)
+SHORTENER_TIMEOUT = float(os.getenv("SHORTENER_TIMEOUT", "6"))
+SHORTENER_SLOW_SECONDS = float(os.getenv("SHORTENER_SLOW_SECONDS", "4"))
+SHORTENER_FAIL_THRESHOLD = int(os.getenv("SHORTENER_FAIL_THRESHOLD", "3"))
+SHORTENER_OPEN_SECONDS = int(os.getenv("SHORTENER_OPEN_SECONDS", "120"))
+# Auto-reply: parallel shortener calls, and the latency budget before falling back to long URLs
+AUTO_REPLY_CANDIDATES = int(os.getenv("AUTO_REPLY_CANDIDATES", "50"))
+AUTO_REPLY_FANOUT = int(os.getenv("AUTO_REPLY_FANOUT", "5"))
+AUTO_REPLY_LINK_DEADLINE = float(os.getenv("AUTO_REPLY_LINK_DEADLINE", "3"))
+
+# Background Jobs & Poster Cache
+TRENDING_REFRESH_INTERVAL = int(os.getenv("TRENDING_REFRESH_INTERVAL", "3600"))
+POSTER_CACHE_SIZE = int(os.getenv("POSTER_CACHE_SIZE", "200"))
+POSTER_CACHE_TTL = int(os.getenv("POSTER_CACHE_TTL", "86400"))
+
+# Stats Counters
+# Recount from the collections this often to correct any drift
+STATS_RECONCILE_INTERVAL = int(os.getenv("STATS_RECONCILE_INTERVAL", "21600"))
+STATS_DAILY_DAYS = int(os.getenv("STATS_DAILY_DAYS", "7"))
+
+# File Record Buffer
+# File records are written behind the upload flow in bulk; unsaved ones are spooled to disk on shutdown
+FILE_BUFFER_SIZE = int(os.getenv("FILE_BUFFER_SIZE", "20"))
+FILE_BUFFER_SECONDS = float(os.getenv("FILE_BUFFER_SECONDS", "2"))
+FILE_BUFFER_SPOOL = os.getenv("FILE_BUFFER_SPOOL", "pending_files.ndjson")
+FILE_BUFFER_MAX_ATTEMPTS = int(os.getenv("FILE_BUFFER_MAX_ATTEMPTS", "5"))
+
+# Backups
+# Gzip NDJSON per collection, split into parts (MTProto uploads allow up to 2 GB per file)
+BACKUP_COLLECTIONS = ["users", "files", "requests"]
+BACKUP_BATCH_SIZE = int(os.getenv("BACKUP_BATCH_SIZE", "1000"))
+BACKUP_PART_MB = int(os.getenv("BACKUP_PART_MB", "1900"))
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", "2000"))
+# Field that marks a document as new/changed, for incremental backups
+BACKUP_CHANGE_FIELDS = {"users": "updated_at", "files": "stored_at", "requests": "date"}
+
+# Poster Rendering
+FONT_CACHE_SIZE = int(os.getenv("FONT_CACHE_SIZE", "16"))
+# Face detection for badge placement: fast | balanced | accurate (full-resolution, whole poster)
+FACE_DETECT_QUALITY = os.getenv("FACE_DETECT_QUALITY", "balanced").lower()
+FACE_DETECT_PRESETS = {
+    # quality: (max detection width in px, share of poster height scanned from the top)
+    "fast": (320, 0.4),
+    "balanced": (480, 0.6),
+    "accurate": (None, 1.0),
+}
+
+# Render Cache, Encoding & Workers
+# Bump RENDER_VERSION whenever watermark_poster output changes (invalidates the render cache)
+RENDER_VERSION = "1"
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", "render_cache")
+RENDER_CACHE_MAX_MB = int(os.getenv("RENDER_CACHE_MAX_MB", "200"))
+# Poster encoding: jpeg | webp | png. POSTER_TARGET_KB > 0 searches the highest quality that fits.
+POSTER_FORMAT = os.getenv("POSTER_FORMAT", "jpeg").lower()
+POSTER_QUALITY = int(os.getenv("POSTER_QUALITY", "90"))
+POSTER_TARGET_KB = int(os.getenv("POSTER_TARGET_KB", "0"))
+POSTER_MAX_SIDE = int(os.getenv("POSTER_MAX_SIDE", "1280"))   # Telegram displays photos at <= 1280px
+# Dedicated render processes (0 = render in the default thread pool instead)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_QUEUE_LIMIT = int(os.getenv("RENDER_QUEUE_LIMIT", "16"))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "60"))
+# Render the un-badged poster in the background as soon as a title is selected
+SPECULATIVE_RENDER = os.getenv("SPECULATIVE_RENDER", "true").lower() == "true"
+
+# Outbound Rate Limits (requests/second, burst) per host
+TMDB_RATE_LIMIT = float(os.getenv("TMDB_RATE_LIMIT", "35"))
+IMAGE_RATE_LIMIT = float(os.getenv("IMAGE_RATE_LIMIT", "20"))
+DEFAULT_RATE_LIMIT = float(os.getenv("DEFAULT_RATE_LIMIT", "5"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_WAIT_BUDGET = float(os.getenv("HTTP_WAIT_BUDGET", "8"))
+
+# TMDB Response Cache (TTL in seconds per endpoint)
+TMDB_CACHE_SIZE = int(os.getenv("TMDB_CACHE_SIZE", "2000"))
+TMDB_CACHE_MONGO = os.getenv("TMDB_CACHE_MONGO", "false").lower() == "true"
+TMDB_CACHE_TTL = {
+    "details": int(os.getenv("TMDB_TTL_DETAILS", "86400")),
+    "videos": int(os.getenv("TMDB_TTL_VIDEOS", "86400")),
+    "search": int(os.getenv("TMDB_TTL_SEARCH", "21600")),
+    "find": int(os.getenv("TMDB_TTL_FIND", "604800")),
+    "trending": int(os.getenv("TMDB_TTL_TRENDING", "3600")),
+}
 
 # Channels & Admin
 FORCE_SUB_CHANNEL = os.getenv("FORCE_SUB_CHANNEL")
@@ -89,10 +201,28 @@ db = db_client[DB_NAME]
 users_collection = db.users
 files_collection = db.files
 requests_collection = db.requests 
+tmdb_cache_collection = db.tmdb_cache
+short_links_collection = db.short_links
+meta_collection = db.meta
+stats_collection = db.stats
+
+# Indexes created at startup: (collection, keys, options). Names are fixed so /indexes can report on them.
+INDEX_SPECS = [
+    (files_collection, [("code", 1)], {"name": "code_1", "unique": True}),
+    (files_collection, [("uploader_id", 1)], {"name": "uploader_id_1"}),
+    (files_collection, [("created_at", -1)], {"name": "created_at_-1"}),
+    (files_collection, [("stored_at", 1)], {"name": "stored_at_1"}),
+    (files_collection, [("title_tokens", 1)], {"name": "title_tokens_1"}),
+    (files_collection, [("tmdb_id", 1), ("media_type", 1)], {"name": "tmdb_id_1_media_type_1"}),
+    (users_collection, [("is_premium", 1)], {"name": "is_premium_1"}),
+    (users_collection, [("updated_at", 1)], {"name": "updated_at_1"}),
+    (requests_collection, [("date", -1)], {"name": "date_-1"}),
+]
 
 # Global Variables
 user_conversations = {}
 BOT_USERNAME = ""
+http_session = None
 
 # Initialize Pyrogram Client
 bot = Client(
@@ -114,8 +244,6 @@ def home():
 def run_flask():
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
 
-Thread(target=run_flask, daemon=True).start()
-
 
 # ==============================================================================
 # 2. HELPER FUNCTIONS & UTILITIES
@@ -132,6 +260,53 @@ def generate_random_code(length=8):
     chars = string.ascii_letters + string.digits
     return ''.join(secrets.choice(chars) for _ in range(length))
 
+def title_tokens(text: str):
+    # Lowercased word tokens of a title; the same normalization is used when storing and searching
+    # Splits on punctuation/symbols/spaces only, so combining marks (e.g. Bangla vowel signs) stay in the word
+    text = re.sub(r"['’`]", "", (text or "").lower())
+    text = "".join(" " if unicodedata.category(ch)[0] in "PSZC" else ch for ch in text)
+    return list(dict.fromkeys(text.split()))
+
+def caption_title(caption: str):
+    # "🎬 **Title (2024)**" -> "Title"; also works on plain text captions read back from Telegram
+    match = re.search(r"🎬[ \t]*(.+)", caption or "")
+    if not match:
+        return None
+    title = match.group(1).replace("**", "").strip()
+    return re.sub(r"\s*\((\d{4}|-{4})\)$", "", title).strip() or None
+
+def caption_field(caption: str, label: str):
+    match = re.search(rf"{label}:\s*(.+)", (caption or "").replace("**", ""))
+    value = match.group(1).strip() if match else None
+    return None if value in (None, "", "Unknown", "N/A") else value
+
+def file_metadata(title, year, quality, language, genres, tmdb_id=None, media_type=None):
+    # Typed fields stored on every file document, so search never has to parse captions
+    return {
+        "title": title,
+        "year": int(year) if year and str(year).isdigit() else None,
+        "quality": quality,
+        "language": None if language in (None, "", "Unknown", "N/A") else language,
+        "genres": [g for g in genres if g],
+        "tmdb_id": int(tmdb_id) if tmdb_id else None,
+        "media_type": media_type,
+        "title_tokens": title_tokens(title),
+    }
+
+def caption_metadata(caption: str, quality: str = None):
+    # Best effort for captions written before typed fields existed (and for channel posts)
+    title = caption_title(caption)
+    year = re.search(r"🎬.*\((\d{4})\)", caption or "")
+    caption_quality = caption_field(caption, "Quality")
+    if not caption_quality and not quality:
+        # /addep files were captioned with just the button name
+        quality, title = title, None
+    genres = caption_field(caption, "Genre")
+    return file_metadata(
+        title, year.group(1) if year else None, quality or caption_quality,
+        caption_field(caption, "Language"), [g.strip() for g in genres.split(",")] if genres else []
+    )
+
 async def auto_delete_message(client, chat_id, message_id, delay_seconds):
     if delay_seconds > 0:
         await asyncio.sleep(delay_seconds)
@@ -140,6 +315,194 @@ async def auto_delete_message(client, chat_id, message_id, delay_seconds):
         except Exception:
             pass
 
+# --- In-Memory TTL Cache ---
+
+class TTLCache:
+    # Size-bounded LRU where every entry carries its own expiry
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+tmdb_cache = TTLCache(TMDB_CACHE_SIZE)
+tmdb_mongo_hits = 0
+poster_cache = TTLCache(POSTER_CACHE_SIZE)
+user_cache = TTLCache(USER_CACHE_SIZE)
+user_loads = {}   # user_id -> writes seen while that user's find_one is in flight
+short_link_cache = TTLCache(SHORT_LINK_CACHE_SIZE)
+
+# --- In-Flight Request Coalescing ---
+
+class SingleFlight:
+    # Concurrent callers asking for the same key await one shared task
+    def __init__(self):
+        self._calls = {}
+
+    def _done(self, key, task):
+        self._calls.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func, *args):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # shield: one impatient caller must not cancel the call for everyone else
+        return await asyncio.shield(task)
+
+inflight = SingleFlight()
+
+# --- Outbound Rate Limiter ---
+
+class RateLimitError(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, deadline: float):
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+                if now + wait > deadline:
+                    raise RateLimitError(f"Rate limit wait budget exceeded ({wait:.1f}s)")
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+host_buckets = {}
+
+def get_host_bucket(host: str) -> TokenBucket:
+    bucket = host_buckets.get(host)
+    if bucket is None:
+        if host == "api.themoviedb.org":
+            rate = TMDB_RATE_LIMIT
+        elif host == "image.tmdb.org":
+            rate = IMAGE_RATE_LIMIT
+        else:
+            rate = DEFAULT_RATE_LIMIT
+        bucket = host_buckets[host] = TokenBucket(rate, max(rate, 1))
+    return bucket
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max((retry_at - datetime.now(retry_at.tzinfo)).total_seconds(), 0)
+        except Exception:
+            return None
+
+def backoff_delay(attempt: int):
+    # Full jitter: uniform(0, 0.5s * 2^attempt), capped at 8s
+    return random.uniform(0, min(8.0, 0.5 * (2 ** attempt)))
+
+async def http_request(url: str, params: dict = None, as_json: bool = True, timeout: float = None, timings: dict = None):
+    # Every outbound call (TMDB, shorteners, posters) goes through the host's bucket.
+    # 429/5xx are retried with Retry-After or jittered backoff inside HTTP_WAIT_BUDGET.
+    # timings["http"] gets the latency of the last attempt alone (no bucket wait, no backoff).
+    bucket = get_host_bucket(urlsplit(url).hostname or "")
+    deadline = time.monotonic() + HTTP_WAIT_BUDGET
+    kwargs = {"params": params}
+    if timeout:
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        await bucket.acquire(deadline)
+        session = await get_http_session()
+        attempt_started = time.monotonic()
+        try:
+            async with session.get(url, **kwargs) as r:
+                if r.status != 429 and r.status < 500:
+                    r.raise_for_status()
+                    return await r.json(content_type=None) if as_json else await r.read()
+                status = r.status
+                delay = parse_retry_after(r.headers.get("Retry-After"))
+        finally:
+            if timings is not None:
+                timings["http"] = time.monotonic() - attempt_started
+
+        if delay is None:
+            delay = backoff_delay(attempt)
+        if status == 429:
+            bucket.pause(delay)
+        if attempt == HTTP_MAX_RETRIES or time.monotonic() + delay > deadline:
+            if status == 429:
+                raise RateLimitError(f"{urlsplit(url).hostname} is rate limiting us")
+            raise aiohttp.ClientResponseError(r.request_info, r.history, status=status)
+        logger.warning(f"HTTP {status} from {urlsplit(url).hostname}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+# --- Shared HTTP Session ---
+
+async def get_http_session() -> aiohttp.ClientSession:
+    # One keep-alive session shared by every handler (no TLS handshake per search)
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=10),
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, ttl_dns_cache=300)
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
 # --- Resource Downloaders ---
 
 def download_cascade():
@@ -166,11 +529,161 @@ def download_font():
             return None
     return font_file
 
+# --- Render Asset Cache ---
+# Fonts and the Haar cascade are loaded once per render worker instead of per poster.
+# Both objects are not safe to share across threads, so each worker thread keeps its own.
+
+_render_local = threading.local()
+_asset_paths = {}
+
+def get_asset_path(name, downloader):
+    if not _asset_paths.get(name):
+        _asset_paths[name] = downloader()
+    return _asset_paths[name]
+
+def get_face_cascade():
+    cascade = getattr(_render_local, "face_cascade", None)
+    if cascade is None:
+        path = get_asset_path("cascade", download_cascade)
+        if not path:
+            return None
+        try:
+            cascade = cv2.CascadeClassifier(path)
+        except Exception:
+            return None
+        if cascade.empty():
+            return None
+        _render_local.face_cascade = cascade
+    return cascade
+
+def get_font(size: int):
+    fonts = getattr(_render_local, "fonts", None)
+    if fonts is None:
+        fonts = _render_local.fonts = OrderedDict()
+    path = get_asset_path("font", download_font)
+    key = (path, size)
+    font = fonts.get(key)
+    if font is None:
+        try:
+            font = ImageFont.truetype(path, size) if path else ImageFont.load_default()
+        except Exception:
+            font = ImageFont.load_default()
+        fonts[key] = font
+        while len(fonts) > FONT_CACHE_SIZE:
+            fonts.popitem(last=False)
+    else:
+        fonts.move_to_end(key)
+    return font
+
+def warm_render_assets():
+    get_face_cascade()
+    get_font(55)   # badge size on a 500px TMDB poster
+    get_font(41)   # watermark size on a 500px TMDB poster
+
 # --- Database Helpers ---
 
+async def load_user(user_id: int):
+    # Single-flight keeps this to one load per user, so the entry lives only while it runs
+    user_loads[user_id] = 0
+    try:
+        user_data = await users_collection.find_one({'_id': user_id}) or {}
+        # A write that landed while we were reading makes this copy stale; serve it but don't cache it
+        if user_loads[user_id] == 0:
+            user_cache.set(user_id, user_data, USER_CACHE_TTL)
+    finally:
+        user_loads.pop(user_id, None)
+    return user_data
+
+async def get_user(user_id: int) -> dict:
+    # Cached user document ({} if unknown). Treat it as read-only; write through update_user().
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        user_data = await inflight.do(("user", user_id), load_user, user_id)
+    return user_data
+
+def invalidate_user(user_id: int):
+    if user_id in user_loads:
+        user_loads[user_id] += 1
+    user_cache.pop(user_id)
+
+async def touch_user(user_id: int):
+    # updated_at is the change marker incremental backups select on; only set it on real changes
+    await users_collection.update_one({'_id': user_id}, {'$set': {'updated_at': datetime.now()}})
+
+async def update_user(user_id: int, update: dict, upsert: bool = False):
+    try:
+        result = await users_collection.update_one({'_id': user_id}, update, upsert=upsert)
+        # e.g. add_user_to_db on every /start: same first_name -> nothing modified -> not "changed"
+        if result.modified_count or result.upserted_id is not None:
+            await touch_user(user_id)
+    finally:
+        invalidate_user(user_id)
+    if result.upserted_id is not None:
+        await bump_stats(users=1)
+    return result
+
+async def set_premium(user_id: int, value: bool):
+    # The pre-update document tells us whether the premium count really changed
+    try:
+        before = await users_collection.find_one_and_update(
+            {'_id': user_id}, {'$set': {'is_premium': value}}, projection={'is_premium': 1}, upsert=value
+        )
+        was_premium = bool(before and before.get('is_premium'))
+        if (before is None and value) or (before is not None and was_premium != value):
+            await touch_user(user_id)
+    finally:
+        invalidate_user(user_id)
+    await bump_stats(users=1 if before is None and value else 0, premium=int(value) - int(was_premium))
+
+# --- Stats Counters ---
+# One "global" document with running totals plus one document per day, both bumped by the write paths
+
+async def bump_stats(**deltas):
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas:
+        return
+    today = datetime.now().strftime("%Y-%m-%d")
+    try:
+        await stats_collection.update_one({'_id': 'global'}, {'$inc': deltas}, upsert=True)
+        await stats_collection.update_one({'_id': f'day:{today}'}, {'$inc': deltas, '$setOnInsert': {'date': today}}, upsert=True)
+    except Exception as e:
+        logger.warning(f"Stats Counter Error: {e}")
+
+async def reconcile_stats():
+    counts = {
+        'users': await users_collection.count_documents({}),
+        'premium': await users_collection.count_documents({'is_premium': True}),
+        'files': await files_collection.count_documents({}),
+        'requests': await requests_collection.count_documents({}),
+    }
+    await stats_collection.update_one({'_id': 'global'}, {'$set': {**counts, 'reconciled_at': datetime.now()}}, upsert=True)
+    return counts
+
+async def stats_reconciler():
+    while True:
+        try:
+            doc = await stats_collection.find_one({'_id': 'global'}, {'reconciled_at': 1})
+            if not doc or not doc.get('reconciled_at') or datetime.now() - doc['reconciled_at'] >= timedelta(seconds=STATS_RECONCILE_INTERVAL):
+                await reconcile_stats()
+        except Exception as e:
+            logger.error(f"Stats Reconcile Error: {e}")
+        await asyncio.sleep(min(STATS_RECONCILE_INTERVAL, 3600))
+
+async def get_stats():
+    doc = await stats_collection.find_one({'_id': 'global'})
+    if not doc or 'reconciled_at' not in doc:
+        # Counters were never seeded (first run): count once, from then on it is a single read
+        doc = await reconcile_stats()
+    return {k: doc.get(k, 0) for k in ('users', 'premium', 'files', 'requests')}
+
+async def daily_stats_text():
+    days = await stats_collection.find({'_id': {'$regex': '^day:'}}).sort('date', -1).to_list(STATS_DAILY_DAYS)
+    lines = [f"`{d['date']}`  👥 +{d.get('users', 0)}  💎 {d.get('premium', 0):+d}  📂 +{d.get('files', 0)}  📨 +{d.get('requests', 0)}" for d in days]
+    return "\n".join(lines) or "No activity recorded yet."
+
 async def add_user_to_db(user):
-    await users_collection.update_one(
-        {'_id': user.id},
+    await update_user(
+        user.id,
         {
             '$set': {'first_name': user.first_name},
             '$setOnInsert': {'is_premium': False, 'delete_timer': 0}
@@ -181,31 +694,459 @@ async def add_user_to_db(user):
 async def is_user_premium(user_id: int) -> bool:
     if user_id == OWNER_ID:
         return True
-    user_data = await users_collection.find_one({'_id': user_id})
-    if user_data:
-        return user_data.get('is_premium', False)
-    return False
+    user_data = await get_user(user_id)
+    return user_data.get('is_premium', False)
 
-async def shorten_link(user_id: int, long_url: str):
-    user_data = await users_collection.find_one({'_id': user_id})
-    
-    if not user_data or 'shortener_api' not in user_data or 'shortener_url' not in user_data:
+async def get_shortener_config(user_id: int):
+    user_data = await get_user(user_id)
+    return user_data.get('shortener_url'), user_data.get('shortener_api')
+
+async def shorten_link(user_id: int, long_url: str, limiter: asyncio.Semaphore = None):
+    base_url, api_key = await get_shortener_config(user_id)
+    if not base_url or not api_key:
         return long_url
 
-    api_key = user_data['shortener_api']
-    base_url = user_data['shortener_url']
-    api_url = f"https://{base_url}/api?api={api_key}&url={long_url}"
-    
+    # A long URL is shortened once per shortener account, then served from memory / short_links
+    memo_key = hashlib.sha1(f"{base_url}|{api_key}|{long_url}".encode("utf-8")).hexdigest()
+    short_url = short_link_cache.get(memo_key)
+    if short_url:
+        return short_url
     try:
-        response = requests.get(api_url, timeout=10)
-        data = response.json()
-        if data.get("status") == "success" and data.get("shortenedUrl"):
-            return data["shortenedUrl"]
-        else:
-            return long_url
+        return await inflight.do(("short", memo_key), resolve_short_link, memo_key, user_id, base_url, api_key, long_url, limiter)
     except Exception:
         return long_url
 
+async def resolve_short_link(memo_key: str, user_id: int, base_url: str, api_key: str, long_url: str, limiter: asyncio.Semaphore = None):
+    doc = None
+    try:
+        doc = await short_links_collection.find_one({'_id': memo_key})
+    except Exception as e:
+        logger.warning(f"Short Link Memo Read Error: {e}")
+
+    if doc:
+        short_url = doc['short_url']
+    else:
+        # The limiter is held here, inside the shielded work, so it stays held after a caller gives up waiting
+        if limiter:
+            async with limiter:
+                short_url = await call_shortener(base_url, api_key, long_url)
+        else:
+            short_url = await call_shortener(base_url, api_key, long_url)
+        if short_url == long_url:
+            return long_url   # failed shortening is not memoized
+        try:
+            await short_links_collection.update_one(
+                {'_id': memo_key},
+                {'$setOnInsert': {'short_url': short_url, 'long_url': long_url, 'uploader_id': user_id,
+                                  'domain': base_url, 'created_at': datetime.now()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Short Link Memo Write Error: {e}")
+
+    short_link_cache.set(memo_key, short_url, SHORT_LINK_CACHE_TTL)
+    return short_url
+
+class CircuitBreaker:
+    # closed -> open after `threshold` consecutive failed or slow calls. While open the caller
+    # gets its fallback immediately; after `open_seconds` one probe call decides (half_open).
+    def __init__(self, name: str, threshold: int, slow_seconds: float, open_seconds: int):
+        self.name = name
+        self.threshold = threshold
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.calls = 0
+        self.failed_calls = 0
+        self.short_circuited = 0
+        self.last_error = None
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.short_circuited += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probing:
+                self.short_circuited += 1
+                return False
+            self.probing = True
+        return True
+
+    def record(self, ok: bool, elapsed: float, error: str = None):
+        self.calls += 1
+        self.probing = False
+        if ok and elapsed < self.slow_seconds:
+            self.failures = 0
+            self.state = "closed"
+            return
+        self.failed_calls += 1
+        self.failures += 1
+        self.last_error = error or f"slow response ({elapsed:.1f}s)"
+        if self.state == "half_open" or self.failures >= self.threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit OPEN for {self.name}: {self.last_error}")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        # The call ended without telling us anything about the domain (cancelled / throttled locally)
+        self.probing = False
+
+    def status_text(self):
+        text = f"{self.name}: {self.state.upper()} | calls {self.calls}, failed {self.failed_calls}, skipped {self.short_circuited}"
+        if self.state != "closed" and self.last_error:
+            text += f"\n   └ {self.last_error[:80]}"
+        return text
+
+shortener_breakers = {}
+
+def get_shortener_breaker(domain: str) -> CircuitBreaker:
+    breaker = shortener_breakers.get(domain)
+    if breaker is None:
+        breaker = shortener_breakers[domain] = CircuitBreaker(
+            domain, SHORTENER_FAIL_THRESHOLD, SHORTENER_SLOW_SECONDS, SHORTENER_OPEN_SECONDS
+        )
+    return breaker
+
+async def call_shortener(base_url: str, api_key: str, long_url: str):
+    # A down shortener serves the long URL instead of stalling uploads for the full timeout.
+    # Only transport errors / slow answers trip the breaker; an API error reply (e.g. bad key) does not.
+    breaker = get_shortener_breaker(base_url)
+    if not breaker.allow():
+        return long_url
+    # Judged on the HTTP attempt alone: waiting in our own rate limiter is not the shortener being slow
+    timings = {}
+    try:
+        data = await http_request(f"https://{base_url}/api", params={"api": api_key, "url": long_url}, timeout=SHORTENER_TIMEOUT, timings=timings)
+    except (RateLimitError, asyncio.CancelledError):
+        breaker.release()
+        raise
+    except Exception as e:
+        breaker.record(False, timings.get("http", 0.0), f"{type(e).__name__}: {e}")
+        raise
+    breaker.record(True, timings["http"])
+    if isinstance(data, dict) and data.get("status") == "success" and data.get("shortenedUrl"):
+        return data["shortenedUrl"]
+    return long_url
+
+# --- Index Bootstrap & Report ---
+
+def index_specs():
+    specs = list(INDEX_SPECS)
+    if TMDB_CACHE_MONGO:
+        specs.append((tmdb_cache_collection, [("expires_at", 1)], {"name": "expires_at_1", "expireAfterSeconds": 0}))
+    return specs
+
+async def ensure_indexes():
+    # create_index is a no-op when the index already exists, so this is safe on every start
+    for collection, keys, options in index_specs():
+        try:
+            await collection.create_index(keys, **options)
+        except DuplicateKeyError:
+            # Old duplicate codes block the unique index; keep lookups fast and leave cleanup to the owner
+            logger.warning(f"Duplicate values in {collection.name}.{options['name']}, creating a non-unique index instead.")
+            try:
+                await collection.create_index(keys, **{k: v for k, v in options.items() if k != "unique"})
+            except Exception as e:
+                logger.warning(f"Index Error ({collection.name}.{options['name']}): {e}")
+        except Exception as e:
+            logger.warning(f"Index Error ({collection.name}.{options['name']}): {e}")
+
+async def index_report_text():
+    lines = []
+    collections = {}
+    for collection, keys, options in index_specs():
+        collections.setdefault(collection.name, (collection, []))[1].append(options)
+    for name, (collection, expected) in collections.items():
+        try:
+            existing = await collection.index_information()
+        except Exception as e:
+            lines.append(f"📁 **{name}**: ⚠️ {e}")
+            continue
+        lines.append(f"📁 **{name}**")
+        for options in expected:
+            info = existing.get(options["name"])
+            if not info:
+                lines.append(f"   ❌ missing: {options['name']}")
+            elif options.get("unique") and not info.get("unique"):
+                lines.append(f"   ⚠️ {options['name']} is not unique (duplicate values)")
+            else:
+                lines.append(f"   ✅ {options['name']}")
+        try:
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        except Exception as e:
+            lines.append(f"   ℹ️ usage stats unavailable: {e}")
+            continue
+        for stat in stats:
+            if stat["name"] == "_id_":
+                continue
+            ops = stat.get("accesses", {}).get("ops", 0)
+            since = stat.get("accesses", {}).get("since")
+            if ops == 0:
+                since_text = since.strftime("%Y-%m-%d %H:%M") if since else "restart"
+                lines.append(f"   💤 unused since {since_text}: {stat['name']}")
+    return "\n".join(lines)
+
+# --- Data Migrations ---
+# Each migration runs once; completion is recorded in the meta collection.
+
+async def backfill_title_tokens():
+    batch = []
+    updated = 0
+    async for doc in files_collection.find({"title_tokens": {"$exists": False}}, {"caption": 1}):
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"title_tokens": title_tokens(caption_title(doc.get("caption")))}}))
+        if len(batch) >= 500:
+            await files_collection.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await files_collection.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    return updated
+
+async def backfill_file_metadata():
+    batch = []
+    updated = 0
+    async for doc in files_collection.find({"quality": {"$exists": False}}, {"caption": 1}):
+        fields = caption_metadata(doc.get("caption"))
+        fields.pop("title_tokens")   # already backfilled, and may carry the /addep post title
+        batch.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+        if len(batch) >= 500:
+            await files_collection.bulk_write(batch, ordered=False)
+            updated += len(batch)
+            batch = []
+    if batch:
+        await files_collection.bulk_write(batch, ordered=False)
+        updated += len(batch)
+    return updated
+
+async def backfill_stored_at():
+    result = await files_collection.update_many(
+        {"stored_at": {"$exists": False}, "created_at": {"$exists": True}}, [{"$set": {"stored_at": "$created_at"}}]
+    )
+    return result.modified_count
+
+MIGRATIONS = [
+    ("files_title_tokens_v1", backfill_title_tokens),
+    ("files_metadata_v1", backfill_file_metadata),
+    ("files_stored_at_v1", backfill_stored_at),
+]
+
+async def run_migrations():
+    for name, migrate in MIGRATIONS:
+        try:
+            if await meta_collection.find_one({"_id": f"migration:{name}"}):
+                continue
+            started = time.monotonic()
+            count = await migrate()
+            await meta_collection.update_one(
+                {"_id": f"migration:{name}"},
+                {"$set": {"done_at": datetime.now(), "documents": count}},
+                upsert=True
+            )
+            logger.info(f"Migration {name}: {count} documents in {time.monotonic() - started:.1f}s")
+        except Exception as e:
+            logger.error(f"Migration {name} failed: {e}")
+
+# --- File Record Write-Behind Buffer ---
+
+class FileRecordBuffer:
+    # Uploads hand their file documents here and move on; a worker inserts them with one
+    # insert_many per FILE_BUFFER_SIZE docs or FILE_BUFFER_SECONDS, whichever comes first.
+    # Deep links check get() first, so a link works before its record reaches MongoDB.
+    def __init__(self, max_docs: int, max_delay: float, spool_path: str):
+        self.max_docs = max_docs
+        self.max_delay = max_delay
+        self.spool_path = spool_path
+        self.pending = OrderedDict()
+        self.attempts = {}
+        self.spooled = set()
+        self._lock = asyncio.Lock()
+        self._has_data = asyncio.Event()
+        self._full = asyncio.Event()
+
+    def get(self, code: str):
+        return self.pending.get(code)
+
+    def has_pending(self, uploader_id: int) -> bool:
+        return any(doc.get("uploader_id") == uploader_id for doc in self.pending.values())
+
+    def _spool(self, docs, path: str, mode: str = "a"):
+        with open(path, mode, encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json_util.dumps(doc) + "\n")
+
+    def add(self, doc: dict):
+        self.pending[doc["code"]] = doc
+        self._has_data.set()
+        if len(self.pending) >= self.max_docs:
+            self._full.set()
+
+    async def flush(self) -> bool:
+        async with self._lock:
+            docs = list(self.pending.values())
+            if not docs:
+                return True
+            failed = set()
+            inserted = len(docs)
+            # Incremental backups select files by the time they reached MongoDB, not when they were buffered
+            stored_at = datetime.now()
+            for doc in docs:
+                doc["stored_at"] = stored_at
+            try:
+                await files_collection.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # A duplicate is either already stored (spool replay) or a code collision; neither is retried
+                errors = e.details.get("writeErrors", [])
+                for err in errors:
+                    if err.get("code") == 11000:
+                        logger.error(f"File Record Duplicate: {docs[err['index']]['code']}")
+                    else:
+                        failed.add(docs[err["index"]]["code"])
+                inserted = e.details.get("nInserted", 0)
+            except Exception as e:
+                logger.error(f"File Record Flush Error: {e}")
+                return False
+            rejected = []
+            for doc in docs:
+                code = doc["code"]
+                if code in failed:
+                    self.attempts[code] = self.attempts.get(code, 0) + 1
+                    if self.attempts[code] < FILE_BUFFER_MAX_ATTEMPTS:
+                        continue
+                    # MongoDB keeps refusing this record (validation, size...): park it for manual review instead of retrying forever
+                    rejected.append(doc)
+                    failed.discard(code)
+                self.attempts.pop(code, None)
+                self.pending.pop(code, None)
+            if rejected:
+                self._spool(rejected, f"{self.spool_path}.rejected")
+                logger.error(f"Moved {len(rejected)} rejected file records to {self.spool_path}.rejected")
+            if self.spooled and self.spooled.isdisjoint(self.pending):
+                # Everything replayed from the spool is stored (or parked), so the file can go now
+                os.remove(self.spool_path)
+                self.spooled.clear()
+            if not self.pending:
+                self._has_data.clear()
+            if len(self.pending) < self.max_docs:
+                self._full.clear()
+        await bump_stats(files=inserted)
+        return not failed
+
+    async def run(self):
+        while True:
+            await self._has_data.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            if not await self.flush():
+                await asyncio.sleep(self.max_delay)
+
+    def load_spool(self):
+        if not os.path.exists(self.spool_path):
+            return 0
+        with open(self.spool_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    self.add(json_util.loads(line))
+        # The file stays until these records are inserted; a crash before then replays it again
+        self.spooled = set(self.pending)
+        return len(self.pending)
+
+    async def close(self):
+        # Last flush on shutdown; whatever MongoDB would not take is kept on disk for the next start
+        await self.flush()
+        if self.pending:
+            # Rewritten, not appended: records still pending from a replayed spool are in self.pending too
+            self._spool(self.pending.values(), self.spool_path, "w")
+            logger.warning(f"Spooled {len(self.pending)} unsaved file records to {self.spool_path}")
+
+file_buffer = FileRecordBuffer(FILE_BUFFER_SIZE, FILE_BUFFER_SECONDS, FILE_BUFFER_SPOOL)
+
+# --- Backup Export ---
+# Runs in a worker thread on the synchronous pymongo client behind motor, so neither the
+# cursor iteration nor the JSON/gzip work touches the event loop.
+
+def export_collection(name: str, directory: str, stamp: str, since: datetime = None):
+    paths = []
+    count = 0
+    part = None
+    limit = BACKUP_PART_MB * 1024 * 1024
+    query = {BACKUP_CHANGE_FIELDS[name]: {"$gte": since}} if since else {}
+    mode = "inc" if since else "full"
+    cursor = db.delegate[name].find(query).sort("_id", 1).batch_size(BACKUP_BATCH_SIZE)
+    try:
+        for doc in cursor:
+            if part is None:
+                paths.append(os.path.join(directory, f"backup_{stamp}_{mode}_{name}.part{len(paths) + 1}.ndjson.gz"))
+                raw = open(paths[-1], "wb")
+                part = gzip.GzipFile(fileobj=raw, mode="wb")
+            part.write(json_util.dumps(doc).encode("utf-8") + b"\n")
+            count += 1
+            if raw.tell() >= limit:
+                part.close()
+                raw.close()
+                part = None
+    finally:
+        cursor.close()
+        if part is not None:
+            part.close()
+            raw.close()
+    return paths, count
+
+def export_backup(directory: str, stamp: str, since: datetime = None):
+    paths = []
+    counts = {}
+    for name in BACKUP_COLLECTIONS:
+        collection_paths, counts[name] = export_collection(name, directory, stamp, since)
+        paths.extend(collection_paths)
+    return paths, counts
+
+def backup_collection_name(filename: str):
+    match = re.search(r"_(users|files|requests)\.part\d+\.ndjson\.gz$", filename or "")
+    return match.group(1) if match else None
+
+def restore_file(path: str, name: str):
+    # Into an empty collection plain unordered inserts are fastest; otherwise upsert by _id so
+    # an incremental archive can be replayed on top of a full one (and re-running is harmless)
+    collection = db.delegate[name]
+    insert_only = collection.estimated_document_count() == 0
+    totals = {"inserted": 0, "upserted": 0, "modified": 0, "errors": 0}
+
+    def flush(batch):
+        try:
+            if insert_only:
+                result = collection.insert_many(batch, ordered=False)
+                totals["inserted"] += len(result.inserted_ids)
+            else:
+                result = collection.bulk_write([ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in batch], ordered=False)
+                totals["upserted"] += result.upserted_count
+                totals["modified"] += result.modified_count
+        except BulkWriteError as e:
+            details = e.details
+            totals["inserted"] += details.get("nInserted", 0)
+            totals["upserted"] += details.get("nUpserted", 0)
+            totals["modified"] += details.get("nModified", 0)
+            totals["errors"] += len(details.get("writeErrors", []))
+
+    batch = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                batch.append(json_util.loads(line))
+            if len(batch) >= RESTORE_BATCH_SIZE:
+                flush(batch)
+                batch = []
+    if batch:
+        flush(batch)
+    return totals
+
 # ==============================================================================
 # 3. DECORATORS
 # ==============================================================================
@@ -244,21 +1185,97 @@ def check_premium(func):
 # 4. IMAGE PROCESSING & CAPTION GENERATION
 # ==============================================================================
 
-def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
+def build_badge_gradient(width: int, height: int, start_color, end_color):
+    # One gradient row computed as an array (same float math as the old per-column loop),
+    # then stretched to full height with a nearest-neighbour resize.
+    if width <= 0 or height <= 0:
+        return Image.new('RGBA', (max(width, 0), max(height, 0)), (0, 0, 0, 0))
+    ratio = (np.arange(width) / width)[:, None]
+    row = np.empty((1, width, 4), dtype=np.uint8)
+    row[0, :, :3] = (np.array(start_color, dtype=np.float64) * (1 - ratio) + np.array(end_color, dtype=np.float64) * ratio).astype(np.uint8)
+    row[0, :, 3] = 255
+    return Image.fromarray(row).resize((width, height), Image.NEAREST)
+
+def detect_faces(image, cascade, band_bottom: float, quality: str = None):
+    # Only faces reaching into the badge band at the top matter, so detection runs on a
+    # downscaled crop of the upper poster and the boxes are mapped back to full resolution.
+    max_width, region_share = FACE_DETECT_PRESETS.get(quality or FACE_DETECT_QUALITY, FACE_DETECT_PRESETS["balanced"])
+    region_h = min(image.height, max(int(band_bottom * 2), int(image.height * region_share)))
+    gray = cv2.cvtColor(np.array(image.crop((0, 0, image.width, region_h)).convert('RGB')), cv2.COLOR_RGB2GRAY)
+
+    scale = 1.0
+    if max_width and image.width > max_width:
+        scale = max_width / image.width
+        gray = cv2.resize(gray, (max_width, max(int(region_h * scale), 1)), interpolation=cv2.INTER_AREA)
+
+    min_face = max(24, int(30 * scale))
+    faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(min_face, min_face))
+    return [tuple(int(v / scale) for v in box) for box in faces]
+
+POSTER_EXTENSIONS = {"jpeg": "jpg", "webp": "webp", "png": "png"}
+
+def poster_filename():
+    return f"poster.{POSTER_EXTENSIONS.get(POSTER_FORMAT, 'jpg')}"
+
+def encode_poster(img):
+    # Telegram recompresses photos anyway, so a lossy encode at display size is enough
+    if POSTER_MAX_SIDE and max(img.size) > POSTER_MAX_SIDE:
+        scale = POSTER_MAX_SIDE / max(img.size)
+        img = img.resize((max(int(img.width * scale), 1), max(int(img.height * scale), 1)), Image.LANCZOS)
+
+    def encode(quality):
+        buffer = io.BytesIO()
+        buffer.name = poster_filename()
+        if POSTER_FORMAT == "png":
+            img.save(buffer, "PNG")
+        elif POSTER_FORMAT == "webp":
+            img.save(buffer, "WEBP", quality=quality)
+        else:
+            img.save(buffer, "JPEG", quality=quality)
+        buffer.seek(0)
+        return buffer
+
+    buffer = encode(POSTER_QUALITY)
+    target = POSTER_TARGET_KB * 1024
+    if POSTER_FORMAT == "png" or not target or buffer.getbuffer().nbytes <= target:
+        return buffer
+
+    # Binary search for the highest quality that fits the byte budget
+    low, high, best = 30, POSTER_QUALITY - 1, None
+    while low <= high:
+        quality = (low + high) // 2
+        candidate = encode(quality)
+        if candidate.getbuffer().nbytes <= target:
+            best, low = candidate, quality + 1
+        else:
+            high = quality - 1
+    return best or encode(30)
+
+class StageTimer:
+    # Adds the wall time since the previous mark to timings[stage]; no-op when timings is None
+    def __init__(self, timings: dict = None):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def mark(self, stage: str):
+        if self.timings is not None:
+            now = time.perf_counter()
+            self.timings[stage] = self.timings.get(stage, 0.0) + (now - self.last)
+            self.last = now
+
+def watermark_poster(poster_input, watermark_text: str, badge_text: str = None, timings: dict = None):
     if not poster_input:
         return None, "Poster not found."
     
+    timer = StageTimer(timings)
     try:
         original_img = None
         if isinstance(poster_input, str):
-            if poster_input.startswith("http"): 
-                img_data = requests.get(poster_input, timeout=15).content
-                original_img = Image.open(io.BytesIO(img_data)).convert("RGBA")
-            else: 
-                if os.path.exists(poster_input):
-                    original_img = Image.open(poster_input).convert("RGBA")
-                else:
-                    return None, f"Local file not found: {poster_input}"
+            # Remote posters are downloaded (rate-limited) by the caller and passed as bytes
+            if os.path.exists(poster_input):
+                original_img = Image.open(poster_input).convert("RGBA")
+            else:
+                return None, f"Local file not found: {poster_input}"
         else: 
             original_img = Image.open(poster_input).convert("RGBA")
             
@@ -268,14 +1285,11 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
         img = Image.new("RGBA", original_img.size)
         img.paste(original_img)
         draw = ImageDraw.Draw(img)
+        timer.mark("decode")
 
         if badge_text and badge_text.strip().lower() != "none":
             badge_font_size = int(img.width / 9)
-            font_path = download_font()
-            try:
-                badge_font = ImageFont.truetype(font_path, badge_font_size) if font_path else ImageFont.load_default()
-            except:
-                badge_font = ImageFont.load_default()
+            badge_font = get_font(badge_font_size)
 
             bbox = draw.textbbox((0, 0), badge_text, font=badge_font)
             text_width = bbox[2] - bbox[0]
@@ -283,19 +1297,18 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
             x = (img.width - text_width) / 2
             
             y_pos = img.height * 0.03
-            cascade_path = download_cascade()
+            face_cascade = get_face_cascade()
+            timer.mark("composite")
             
-            if cascade_path:
+            if face_cascade is not None:
                 try:
-                    cv_image = np.array(original_img.convert('RGB'))
-                    gray = cv2.cvtColor(cv_image, cv2.COLOR_RGB2GRAY)
-                    face_cascade = cv2.CascadeClassifier(cascade_path)
-                    faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
-                    
-                    is_collision = False
                     padding = int(badge_font_size * 0.2)
                     text_box_y1 = y_pos + text_height + padding
+                    faces = detect_faces(original_img, face_cascade, text_box_y1)
+                    if timings is not None:
+                        timings["faces"] = len(faces)
                     
+                    is_collision = False
                     for (fx, fy, fw, fh) in faces:
                         if y_pos < (fy + fh) and text_box_y1 > fy:
                             is_collision = True
@@ -305,6 +1318,7 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
                         y_pos = img.height * 0.25
                 except Exception:
                     pass
+            timer.mark("face_detect")
 
             y = y_pos
             padding = int(badge_font_size * 0.15)
@@ -317,23 +1331,14 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
             )
             img = Image.alpha_composite(img, rect_layer)
             draw = ImageDraw.Draw(img)
+            timer.mark("composite")
 
-            gradient = Image.new('RGBA', (text_width, text_height + int(padding)), (0, 0, 0, 0))
-            gradient_draw = ImageDraw.Draw(gradient)
-            
-            start_color = (255, 255, 0)
-            end_color = (255, 69, 0)
-            
-            for i in range(text_width):
-                ratio = i / text_width
-                r = int(start_color[0] * (1 - ratio) + end_color[0] * ratio)
-                g = int(start_color[1] * (1 - ratio) + end_color[1] * ratio)
-                b = int(start_color[2] * (1 - ratio) + end_color[2] * ratio)
-                gradient_draw.line([(i, 0), (i, text_height + padding)], fill=(r, g, b, 255))
+            gradient = build_badge_gradient(text_width, text_height + int(padding), (255, 255, 0), (255, 69, 0))
             
             mask = Image.new('L', (text_width, text_height + int(padding)), 0)
             mask_draw = ImageDraw.Draw(mask)
             mask_draw.text((0, 0), badge_text, font=badge_font, fill=255)
+            timer.mark("gradient")
             
             try:
                 img.paste(gradient, (int(x), int(y)), mask)
@@ -342,10 +1347,7 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
 
         if watermark_text:
             font_size = int(img.width / 12)
-            try:
-                font = ImageFont.truetype(download_font(), font_size)
-            except:
-                font = ImageFont.load_default()
+            font = get_font(font_size)
             
             bbox = draw.textbbox((0, 0), watermark_text, font=font)
             text_width = bbox[2] - bbox[0]
@@ -354,11 +1356,10 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
             
             draw.text((wx + 2, wy + 2), watermark_text, font=font, fill=(0, 0, 0, 128))
             draw.text((wx, wy), watermark_text, font=font, fill=(255, 255, 255, 200))
+        timer.mark("composite")
             
-        buffer = io.BytesIO()
-        buffer.name = "poster.png"
-        img.convert("RGB").save(buffer, "PNG")
-        buffer.seek(0)
+        buffer = encode_poster(img.convert("RGB"))
+        timer.mark("encode")
         return buffer, None
 
     except Exception as e:
@@ -367,45 +1368,86 @@ def watermark_poster(poster_input, watermark_text: str, badge_text: str = None):
 
 # --- TMDB & IMDb Functions ---
 
-def get_tmdb_trailer(media_type, media_id):
-    url = f"https://api.themoviedb.org/3/{media_type}/{media_id}/videos?api_key={TMDB_API_KEY}"
+async def tmdb_fetch(path: str, params: dict):
+    return await http_request(f"{TMDB_BASE_URL}/{path}", params={**params, "api_key": TMDB_API_KEY})
+
+async def tmdb_load(kind: str, key: str, path: str, params: dict):
+    global tmdb_mongo_hits
+    ttl = TMDB_CACHE_TTL.get(kind, 3600)
+    if TMDB_CACHE_MONGO:
+        try:
+            doc = await tmdb_cache_collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now()}})
+            if doc:
+                tmdb_mongo_hits += 1
+                data = json.loads(doc["data"])
+                remaining = (doc["expires_at"] - datetime.now()).total_seconds()
+                tmdb_cache.set(key, data, max(remaining, 1))
+                return data
+        except Exception as e:
+            logger.warning(f"TMDB Cache Read Error: {e}")
+
+    data = await tmdb_fetch(path, params)
+    tmdb_cache.set(key, data, ttl)
+    if TMDB_CACHE_MONGO:
+        try:
+            await tmdb_cache_collection.replace_one(
+                {"_id": key},
+                {"data": json.dumps(data), "expires_at": datetime.now() + timedelta(seconds=ttl)},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"TMDB Cache Write Error: {e}")
+    return data
+
+async def tmdb_get(kind: str, path: str, **params):
+    # Memory LRU -> Mongo (optional) -> TMDB. Errors are never cached.
+    key = path + "?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+    data = tmdb_cache.get(key)
+    if data is None:
+        data = await inflight.do(("tmdb", key), tmdb_load, kind, key, path, params)
+    return copy.deepcopy(data)
+
+def tmdb_cache_stats_text():
+    total = tmdb_cache.hits + tmdb_cache.misses
+    ratio = (tmdb_cache.hits + tmdb_mongo_hits) / total * 100 if total else 0
+    return (f"🗄 TMDB Cache: {len(tmdb_cache)} items | "
+            f"Hits: {tmdb_cache.hits} mem / {tmdb_mongo_hits} db | "
+            f"Misses: {tmdb_cache.misses - tmdb_mongo_hits} ({ratio:.0f}% hit)")
+
+def extract_trailer(videos: dict):
+    for vid in (videos or {}).get("results",[]):
+        if vid.get("site") == "YouTube" and vid.get("type") == "Trailer":
+            return f"https://www.youtube.com/watch?v={vid.get('key')}"
+    return None
+
+async def get_tmdb_trailer(media_type, media_id):
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
-        for vid in data.get("results",[]):
-            if vid.get("site") == "YouTube" and vid.get("type") == "Trailer":
-                return f"https://www.youtube.com/watch?v={vid.get('key')}"
+        return extract_trailer(await tmdb_get("videos", f"{media_type}/{media_id}/videos"))
     except Exception:
-        pass
-    return None
+        return None
 
-def get_trending_today():
-    url = f"https://api.themoviedb.org/3/trending/all/day?api_key={TMDB_API_KEY}"
+async def get_trending_today():
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        return r.json().get("results", [])[:10]
+        data = await tmdb_get("trending", "trending/all/day")
+        return data.get("results", [])[:10]
+    except RateLimitError:
+        raise
     except Exception:
         return[]
 
-def search_tmdb(query: str):
-    url = f"https://api.themoviedb.org/3/search/multi?api_key={TMDB_API_KEY}&query={query}&include_adult=true&page=1"
+async def search_tmdb(query: str):
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        data = await tmdb_get("search", "search/multi", query=query, include_adult="true", page="1")
         results = data.get("results", [])
         return [res for res in results if res.get("media_type") in["movie", "tv"]][:8] 
+    except RateLimitError:
+        raise
     except Exception:
         return[]
 
-def search_by_imdb(imdb_id: str):
-    url = f"https://api.themoviedb.org/3/find/{imdb_id}?api_key={TMDB_API_KEY}&external_source=imdb_id"
+async def search_by_imdb(imdb_id: str):
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        data = await tmdb_get("find", f"find/{imdb_id}", external_source="imdb_id")
         results =[]
         for item in data.get("movie_results", []):
             item['media_type'] = 'movie'
@@ -414,20 +1456,355 @@ def search_by_imdb(imdb_id: str):
             item['media_type'] = 'tv'
             results.append(item)
         return results
+    except RateLimitError:
+        raise
     except Exception:
         return[]
 
-def get_tmdb_details(media_type, media_id):
-    url = f"https://api.themoviedb.org/3/{media_type}/{media_id}?api_key={TMDB_API_KEY}"
+async def get_tmdb_details(media_type, media_id):
     try:
-        r = requests.get(url, timeout=10)
-        r.raise_for_status()
-        data = r.json()
+        params = {}
+        if TMDB_DETAILS_APPEND:
+            params["append_to_response"] = TMDB_DETAILS_APPEND
+            if "images" in TMDB_DETAILS_APPEND:
+                params["include_image_language"] = "en,null"
+        data = await tmdb_get("details", f"{media_type}/{media_id}", **params)
         data['media_type'] = media_type 
         return data
+    except RateLimitError:
+        raise
     except Exception:
         return None
 
+# --- Poster Download Cache ---
+
+def tmdb_poster_url(details: dict):
+    if details and details.get('poster_path'):
+        return f"{TMDB_POSTER_BASE}{details['poster_path']}"
+    return None
+
+async def download_poster(url: str):
+    data = await http_request(url, as_json=False, timeout=15)
+    poster_cache.set(url, data, POSTER_CACHE_TTL)
+    return data
+
+async def fetch_poster_bytes(url: str):
+    data = poster_cache.get(url)
+    if data is None:
+        data = await inflight.do(("poster", url), download_poster, url)
+    return data
+
+# --- Render Engine (Process Pool) ---
+
+class RenderBusyError(Exception):
+    pass
+
+def render_job(poster_input, watermark_text, badge_text):
+    # Runs inside a render worker; only plain bytes cross the process boundary
+    if isinstance(poster_input, bytes):
+        poster_input = io.BytesIO(poster_input)
+    buffer, error = watermark_poster(poster_input, watermark_text, badge_text)
+    return (buffer.getvalue() if buffer else None), error
+
+class RenderEngine:
+    # Poster renders get their own bounded process pool, so Pillow/OpenCV work neither
+    # waits behind blocking network calls in the default thread pool nor fights for the GIL.
+    def __init__(self, workers: int, queue_limit: int, timeout: float):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.pending = 0
+        # Speculative renders have their own slots, always leaving a worker free for FINISH
+        self.speculative = 0
+        self.speculative_limit = max(workers, 1) - 1
+        self._pool = None
+        self._jobs = {}   # pool -> renders on it that a caller is still waiting for
+
+    def start(self, wait: bool = True, fork: bool = False):
+        if self.workers <= 0 or self._pool:
+            return
+        # Forking is only safe at boot, before the Flask and pyrogram threads exist; pools started
+        # later (after a crash or a hung render) come from a clean forkserver/spawn interpreter
+        methods = multiprocessing.get_all_start_methods()
+        method = "fork" if fork else ("forkserver" if "forkserver" in methods else "spawn")
+        ctx = multiprocessing.get_context(method) if method in methods else None
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx, initializer=warm_render_assets)
+        self._jobs[self._pool] = set()
+        # The executor forks its workers on the first submit; do it now rather than on the first FINISH
+        warmup = self._pool.submit(os.getpid)
+        if wait:
+            warmup.result()
+
+    def shutdown(self):
+        for pool in list(self._jobs):
+            pool.shutdown(wait=False, cancel_futures=True)
+        self._jobs.clear()
+        self._pool = None
+
+    def _finished(self, pool, counted, job):
+        if counted:
+            self.pending -= 1
+        self._release(pool, job)
+        if not job.cancelled():
+            job.exception()
+
+    def _release(self, pool, job):
+        jobs = self._jobs.get(pool)
+        if jobs is None:
+            return
+        jobs.discard(job)
+        if not jobs and pool is not self._pool:
+            # Nobody waits on the retired pool any more, so whatever still runs there is an overrun
+            # render; it can't be cancelled, terminating the workers is the only way to get them back
+            del self._jobs[pool]
+            for process in list((getattr(pool, "_processes", None) or {}).values()):
+                process.terminate()
+            pool.shutdown(wait=False)
+
+    def _retire(self, pool, job):
+        # New renders go to a fresh pool; other uploaders' renders already on this one finish there
+        if self._pool is pool:
+            self._pool = None
+            self.start(wait=False)
+        self._release(pool, job)
+
+    def try_render_speculative(self) -> bool:
+        # Checks and reserves in one step (no await in between), so a burst of prefetches woken
+        # together can't all pass; the caller hands the slot back with end_speculative()
+        if self.speculative >= self.speculative_limit or self.pending + self.speculative >= max(self.workers, 1):
+            return False
+        self.speculative += 1
+        return True
+
+    def end_speculative(self):
+        self.speculative -= 1
+
+    async def render(self, poster_input, watermark_text, badge_text, speculative: bool = False):
+        # Backpressure: refuse new work once every worker is busy and the queue is full.
+        # Speculative renders already hold a slot from try_render_speculative() and don't count here.
+        if not speculative and self.pending >= max(self.workers, 1) + self.queue_limit:
+            raise RenderBusyError(f"Render queue is full ({self.pending} pending)")
+        if isinstance(poster_input, io.BytesIO):
+            poster_input = poster_input.getvalue()
+
+        pool = None
+        if self.workers <= 0:
+            job = asyncio.ensure_future(asyncio.to_thread(render_job, poster_input, watermark_text, badge_text))
+        else:
+            self.start(wait=False)
+            pool = self._pool
+            job = asyncio.get_running_loop().run_in_executor(pool, render_job, poster_input, watermark_text, badge_text)
+            self._jobs[pool].add(job)
+        # pending drops when the work really ends, not when the caller stops waiting for it
+        if not speculative:
+            self.pending += 1
+        job.add_done_callback(functools.partial(self._finished, pool, not speculative))
+        try:
+            data, error = await asyncio.wait_for(asyncio.shield(job), self.timeout)
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM on a huge photo); start a fresh pool for the next render
+            self._retire(pool, job)
+            return None, "Render worker crashed. Please try again."
+        except asyncio.TimeoutError:
+            if pool:
+                self._retire(pool, job)
+            return None, f"Render timed out after {self.timeout:.0f}s."
+
+        if not data:
+            return None, error
+        buffer = io.BytesIO(data)
+        buffer.name = poster_filename()
+        return buffer, None
+
+render_engine = RenderEngine(RENDER_WORKERS, RENDER_QUEUE_LIMIT, RENDER_TIMEOUT)
+
+# --- Rendered Poster Cache ---
+
+class RenderCache:
+    # Content-addressed store of rendered posters: <key>.img holds the encoded bytes,
+    # <key>.fid the Telegram file_id of the first upload. Evicted LRU by total size.
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def make_key(self, poster_source: str, watermark_text: str, badge_text: str):
+        if not poster_source.startswith("http"):
+            with open(poster_source, "rb") as f:
+                poster_source = "sha256:" + hashlib.sha256(f.read()).hexdigest()
+        if not badge_text or badge_text.strip().lower() == "none":
+            badge_text = ""
+        encoding = [POSTER_FORMAT, POSTER_QUALITY, POSTER_TARGET_KB, POSTER_MAX_SIDE]
+        raw = json.dumps([poster_source, watermark_text or "", badge_text, RENDER_VERSION, encoding])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    def get_file_id(self, key):
+        try:
+            with open(self._path(key, "fid"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+    def set_file_id(self, key, file_id):
+        try:
+            with open(self._path(key, "fid"), "w", encoding="utf-8") as f:
+                f.write(file_id)
+        except OSError as e:
+            logger.warning(f"Render Cache Write Error: {e}")
+
+    def get_bytes(self, key):
+        path = self._path(key, "img")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            self.hits += 1
+            return data
+        except OSError:
+            self.misses += 1
+            return None
+
+    def put_bytes(self, key, data: bytes):
+        try:
+            tmp_path = self._path(key, "tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key, "img"))
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Render Cache Write Error: {e}")
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name[:-4]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for ext in ("img", "fid"):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            total -= size
+
+render_cache = RenderCache(RENDER_CACHE_DIR, RENDER_CACHE_MAX_MB * 1024 * 1024)
+
+async def render_poster_bytes(poster_source: str, watermark_text: str, badge_text: str, render_key: str = None, speculative: bool = False):
+    poster_input = poster_source
+    if poster_source.startswith("http"):
+        try:
+            poster_input = io.BytesIO(await fetch_poster_bytes(poster_source))
+        except RateLimitError:
+            return None, "Poster server is busy. Please try again in a few seconds."
+        except Exception as e:
+            return None, str(e)
+
+    try:
+        poster_buffer, error = await render_engine.render(poster_input, watermark_text, badge_text, speculative)
+    except RenderBusyError:
+        return None, "Too many posters are being generated right now. Please try again in a moment."
+    if not poster_buffer:
+        return None, error
+    data = poster_buffer.getvalue()
+    if render_key:
+        await asyncio.to_thread(render_cache.put_bytes, render_key, data)
+    return data, None
+
+async def render_poster(poster_source: str, watermark_text: str, badge_text: str, render_key: str = None, speculative: bool = False):
+    # Returns (BytesIO, error). Served from the render cache when the same inputs were rendered
+    # before; a render already running for the same key (e.g. a prefetch) is joined, not repeated.
+    if render_key:
+        data = await asyncio.to_thread(render_cache.get_bytes, render_key)
+        if not data:
+            data, error = await inflight.do(("render", render_key), render_poster_bytes, poster_source, watermark_text, badge_text, render_key, speculative)
+    else:
+        data, error = await render_poster_bytes(poster_source, watermark_text, badge_text, speculative=speculative)
+    if not data:
+        return None, error
+    buffer = io.BytesIO(data)
+    buffer.name = poster_filename()
+    return buffer, None
+
+# --- Poster Prefetch ---
+# Started as soon as a title is picked, so the poster (and usually the finished render)
+# is ready by the time the uploader taps FINISH.
+
+async def prefetch_poster(uid: int, details: dict):
+    poster_url = tmdb_poster_url(details)
+    try:
+        await fetch_poster_bytes(poster_url)
+        if not SPECULATIVE_RENDER or not render_engine.try_render_speculative():
+            return
+        try:
+            user_data = await get_user(uid)
+            watermark_text = user_data.get('watermark_text')
+            render_key = render_cache.make_key(poster_url, watermark_text, None)
+            if not render_cache.get_file_id(render_key):
+                await render_poster(poster_url, watermark_text, None, render_key, speculative=True)
+        finally:
+            render_engine.end_speculative()
+    except Exception as e:
+        logger.warning(f"Poster Prefetch Error: {e}")
+
+prefetch_tasks = set()
+
+def start_poster_prefetch(uid: int, details: dict):
+    if tmdb_poster_url(details):
+        task = asyncio.create_task(prefetch_poster(uid, details))
+        prefetch_tasks.add(task)
+        task.add_done_callback(prefetch_tasks.discard)
+
+# --- Trending Snapshot (Background Refresh) ---
+
+trending_snapshot = {"items": [], "details": {}, "updated_at": None}
+
+async def refresh_trending_snapshot():
+    global trending_snapshot
+    items = await get_trending_today()
+    if not items:
+        return
+    sem = asyncio.Semaphore(5)
+
+    async def prefetch(item):
+        m_type = item.get('media_type', 'movie')
+        async with sem:
+            details = await get_tmdb_details(m_type, item['id'])
+            if details and tmdb_poster_url(details):
+                try:
+                    await fetch_poster_bytes(tmdb_poster_url(details))
+                except Exception as e:
+                    logger.warning(f"Trending Poster Prefetch Error: {e}")
+        return (m_type, str(item['id'])), details
+
+    fetched = await asyncio.gather(*[prefetch(i) for i in items if i.get('media_type') in ["movie", "tv"]])
+    trending_snapshot = {
+        "items": items,
+        "details": {key: d for key, d in fetched if d},
+        "updated_at": datetime.now()
+    }
+    logger.info(f"Trending snapshot refreshed ({len(items)} items).")
+
+async def trending_refresher():
+    while True:
+        try:
+            await refresh_trending_snapshot()
+        except Exception as e:
+            logger.error(f"Trending Refresh Error: {e}")
+        await asyncio.sleep(TRENDING_REFRESH_INTERVAL)
+
+def get_trending_details(media_type, media_id):
+    details = trending_snapshot["details"].get((media_type, str(media_id)))
+    return copy.deepcopy(details) if details else None
+
 def extract_id_from_url(url: str):
     tmdb_pattern = r"themoviedb\.org/(movie|tv)/(\d+)"
     tmdb_match = re.search(tmdb_pattern, url)
@@ -498,7 +1875,7 @@ async def cancel_process_cmd(client, message: Message):
 @force_subscribe
 async def settings_dashboard(client, message: Message):
     uid = message.from_user.id
-    user_data = await users_collection.find_one({'_id': uid})
+    user_data = await get_user(uid)
     if not user_data:
         return await message.reply_text("❌ User data not found. Type /start first.")
 
@@ -526,31 +1903,109 @@ async def settings_dashboard(client, message: Message):
 async def backup_db_cmd(client, message: Message):
     if message.from_user.id != OWNER_ID:
         return
+    incremental = len(message.command) > 1 and message.command[1].lower() in ("inc", "incremental")
     msg = await message.reply_text("🔄 **Generating Database Backup...**")
+    directory = tempfile.mkdtemp(prefix="backup_")
     try:
-        users = await users_collection.find({}).to_list(None)
-        files = await files_collection.find({}).to_list(None)
-        
-        backup_data = {"users": users, "files": files}
-        
-        with open("db_backup.json", "w", encoding="utf-8") as f:
-            json.dump(backup_data, f, default=str, indent=4)
-            
-        await message.reply_document("db_backup.json", caption="📦 **Database Backup Successfully Generated.**")
-        os.remove("db_backup.json")
-        await msg.delete()
+        since = None
+        if incremental:
+            checkpoint = await meta_collection.find_one({'_id': 'backup_checkpoint'})
+            if checkpoint:
+                since = checkpoint['at']
+            else:
+                await msg.edit_text("ℹ️ **No previous backup found, making a full backup...**")
+        # Buffered file records get stored_at when they are flushed; write them out before the checkpoint
+        await file_buffer.flush()
+        # Taken before reading, so anything written during the export is picked up again next time
+        started_at = datetime.now()
+        stamp = started_at.strftime("%Y%m%d_%H%M%S")
+        paths, counts = await asyncio.to_thread(export_backup, directory, stamp, since)
+        summary = " | ".join(f"{name}: {count}" for name, count in counts.items())
+        kind = f"Incremental since {since:%Y-%m-%d %H:%M}" if since else "Full"
+        if not paths:
+            if since:
+                await msg.edit_text(f"✅ **Nothing changed since {since:%Y-%m-%d %H:%M}.**")
+            else:
+                await msg.edit_text("✅ **Database is empty, nothing to back up.**")
+        else:
+            await msg.edit_text(f"📤 **Uploading {len(paths)} backup file(s)...**\n{summary}")
+            for i, path in enumerate(paths, 1):
+                await message.reply_document(path, caption=f"📦 **Database Backup** `{stamp}` ({i}/{len(paths)})\n{kind} | {summary}")
+            await msg.delete()
+        await meta_collection.update_one(
+            {'_id': 'backup_checkpoint'}, {'$set': {'at': started_at, 'counts': counts, 'incremental': bool(since)}}, upsert=True
+        )
     except Exception as e:
         await msg.edit_text(f"❌ **Backup Failed:** {str(e)}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+@bot.on_message(filters.command("restore") & filters.private)
+async def restore_db_cmd(client, message: Message):
+    if message.from_user.id != OWNER_ID:
+        return
+    document = message.reply_to_message.document if message.reply_to_message else None
+    name = backup_collection_name(document.file_name) if document else None
+    if not name:
+        return await message.reply_text(
+            "⚠️ **Usage:** Reply to a backup file (`..._files.part1.ndjson.gz`) with /restore.\n"
+            "Restore the full backup first, then incremental ones in order."
+        )
+    msg = await message.reply_text(f"📥 **Downloading `{document.file_name}`...**")
+    directory = tempfile.mkdtemp(prefix="restore_")
+    try:
+        path = await message.reply_to_message.download(file_name=os.path.join(directory, document.file_name))
+        await msg.edit_text(f"♻️ **Restoring into `{name}`...**")
+        started = time.monotonic()
+        totals = await asyncio.to_thread(restore_file, path, name)
+        if name == "users":
+            user_cache.clear()
+        await reconcile_stats()
+        await msg.edit_text(
+            f"✅ **Restore Complete:** `{name}` in {time.monotonic() - started:.1f}s\n\n"
+            f"➕ Inserted: {totals['inserted'] + totals['upserted']}\n"
+            f"🔄 Updated: {totals['modified']}\n"
+            f"⚠️ Errors: {totals['errors']}"
+        )
+    except Exception as e:
+        await msg.edit_text(f"❌ **Restore Failed:** {str(e)}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
 # --- ADMIN DIRECT COMMANDS ---
+@bot.on_message(filters.command("health") & filters.private)
+async def health_command(client, message: Message):
+    if message.from_user.id != OWNER_ID: return
+    breakers = "\n".join(b.status_text() for b in shortener_breakers.values()) or "No shortener calls yet."
+    buckets = "\n".join(
+        f"{host}: {b.rate:g}/s, {b.tokens:.1f} tokens" + (" (paused)" if b.blocked_until > time.monotonic() else "")
+        for host, b in host_buckets.items()
+    ) or "No outbound calls yet."
+    await message.reply_text(
+        f"🩺 **Bot Health**\n\n"
+        f"🔗 **Shortener Circuits:**\n{breakers}\n\n"
+        f"🚦 **Rate Limits:**\n{buckets}\n\n"
+        f"🖼 **Render Engine:** {render_engine.pending} pending, {render_engine.speculative} speculative / {render_engine.workers} workers | "
+        f"cache hits {render_cache.hits}, misses {render_cache.misses}\n"
+        f"👤 **User Cache:** {len(user_cache)} profiles | hits {user_cache.hits}, misses {user_cache.misses}\n"
+        f"📝 **File Write Buffer:** {len(file_buffer.pending)} pending\n"
+        f"{tmdb_cache_stats_text()}"
+    )
+
 @bot.on_message(filters.command("stats") & filters.private)
 async def stats_command(client, message: Message):
     if message.from_user.id != OWNER_ID: return
-    total = await users_collection.count_documents({})
-    prem = await users_collection.count_documents({'is_premium': True})
-    files = await files_collection.count_documents({})
-    reqs = await requests_collection.count_documents({})
-    await message.reply_text(f"📊 **Bot Statistics:**\n\n👥 Total Users: {total}\n💎 Premium Users: {prem}\n📂 Total Files: {files}\n📨 Pending Requests: {reqs}")
+    stats = await get_stats()
+    await message.reply_text(
+        f"📊 **Bot Statistics:**\n\n👥 Total Users: {stats['users']}\n💎 Premium Users: {stats['premium']}\n"
+        f"📂 Total Files: {stats['files']}\n📨 Pending Requests: {stats['requests']}\n\n"
+        f"📅 **Daily Activity:**\n{await daily_stats_text()}\n\n{tmdb_cache_stats_text()}"
+    )
+
+@bot.on_message(filters.command("indexes") & filters.private)
+async def indexes_command(client, message: Message):
+    if message.from_user.id != OWNER_ID: return
+    await message.reply_text(f"🗂 **Database Indexes:**\n\n{await index_report_text()}")
 
 @bot.on_message(filters.command("broadcast") & filters.private)
 async def broadcast_command(client, message: Message):
@@ -564,7 +2019,7 @@ async def add_premium_cmd(client, message: Message):
     if len(message.command) > 1:
         try:
             user_id = int(message.command[1])
-            await users_collection.update_one({'_id': user_id}, {'$set': {'is_premium': True}}, upsert=True)
+            await set_premium(user_id, True)
             await message.reply_text(f"✅ Premium Added to ID: `{user_id}`")
         except:
             await message.reply_text("❌ Invalid ID format.")
@@ -578,7 +2033,7 @@ async def rem_premium_cmd(client, message: Message):
     if len(message.command) > 1:
         try:
             user_id = int(message.command[1])
-            await users_collection.update_one({'_id': user_id}, {'$set': {'is_premium': False}})
+            await set_premium(user_id, False)
             await message.reply_text(f"✅ Premium Removed from ID: `{user_id}`")
         except:
             await message.reply_text("❌ Invalid ID format.")
@@ -600,7 +2055,7 @@ async def start_cmd(client, message: Message):
     # --- FILE RETRIEVAL SYSTEM ---
     if len(message.command) > 1:
         code = message.command[1]
-        file_data = await files_collection.find_one({"code": code})
+        file_data = file_buffer.get(code) or await files_collection.find_one({"code": code})
         
         if file_data:
             msg = await message.reply_text("📂 **Fetching your file...**")
@@ -689,11 +2144,8 @@ async def callback_handler(client, cb: CallbackQuery):
         
     elif data.startswith("admin_") and uid == OWNER_ID:
         if data == "admin_stats":
-            total = await users_collection.count_documents({})
-            prem = await users_collection.count_documents({'is_premium': True})
-            files = await files_collection.count_documents({})
-            reqs = await requests_collection.count_documents({})
-            await cb.answer(f"📊 Total Users: {total}\n💎 Premium: {prem}\n📂 Files: {files}\n📨 Requests: {reqs}", show_alert=True)
+            stats = await get_stats()
+            await cb.answer(f"📊 Total Users: {stats['users']}\n💎 Premium: {stats['premium']}\n📂 Files: {stats['files']}\n📨 Requests: {stats['requests']}", show_alert=True)
             
         elif data == "admin_broadcast":
             await cb.message.edit_text("📢 **Broadcast Mode**\n\nSend message to broadcast.\n(Type /cancel to stop)")
@@ -725,27 +2177,27 @@ async def settings_commands(client, message: Message):
     if cmd == "setwatermark":
         text = " ".join(message.command[1:])
         if text.lower() in ['none', 'off', 'clear']: text = ""
-        await users_collection.update_one({'_id': uid}, {'$set': {'watermark_text': text}}, upsert=True)
+        await update_user(uid, {'$set': {'watermark_text': text}}, upsert=True)
         await message.reply_text(f"✅ Watermark set: `{text}`")
 
     elif cmd == "setdomain":
         if len(message.command) > 1:
             domain = message.command[1].replace("https://", "").replace("http://", "").strip("/")
-            await users_collection.update_one({'_id': uid}, {'$set': {'shortener_url': domain}}, upsert=True)
+            await update_user(uid, {'$set': {'shortener_url': domain}}, upsert=True)
             await message.reply_text(f"✅ Shortener Domain Saved: `{domain}`")
         else:
             await message.reply_text("❌ Usage: `/setdomain shareus.io`")
 
     elif cmd == "setapi":
         if len(message.command) > 1:
-            await users_collection.update_one({'_id': uid}, {'$set': {'shortener_api': message.command[1]}}, upsert=True)
+            await update_user(uid, {'$set': {'shortener_api': message.command[1]}}, upsert=True)
             await message.reply_text("✅ API Key Saved.")
         else: await message.reply_text("❌ Usage: `/setapi KEY`")
 
     elif cmd == "settutorial":
         if len(message.command) > 1:
             link = message.command[1]
-            await users_collection.update_one({'_id': uid}, {'$set': {'tutorial_url': link}}, upsert=True)
+            await update_user(uid, {'$set': {'tutorial_url': link}}, upsert=True)
             await message.reply_text(f"✅ Tutorial Link Saved.")
         else: await message.reply_text("❌ Usage: `/settutorial link`")
 
@@ -753,11 +2205,11 @@ async def settings_commands(client, message: Message):
         if len(message.command) > 1:
             try:
                 mins = int(message.command[1])
-                await users_collection.update_one({'_id': uid}, {'$set': {'delete_timer': mins*60}}, upsert=True)
+                await update_user(uid, {'$set': {'delete_timer': mins*60}}, upsert=True)
                 await message.reply_text(f"✅ Timer set: **{mins} Minutes**")
             except: await message.reply_text("❌ Usage: `/settimer 10`")
         else:
-            await users_collection.update_one({'_id': uid}, {'$set': {'delete_timer': 0}})
+            await update_user(uid, {'$set': {'delete_timer': 0}})
             await message.reply_text("✅ Auto-Delete DISABLED.")
 
     elif cmd == "addchannel":
@@ -767,7 +2219,7 @@ async def settings_commands(client, message: Message):
                 chat_info = await client.get_chat(int(cid) if cid.lstrip('-').isdigit() else cid)
                 real_cid = str(chat_info.id)
                 chat_title = chat_info.title
-                await users_collection.update_one({'_id': uid}, {'$addToSet': {'channel_ids': real_cid}}, upsert=True)
+                await update_user(uid, {'$addToSet': {'channel_ids': real_cid}}, upsert=True)
                 await message.reply_text(f"✅ Channel **{chat_title}** (`{real_cid}`) added successfully.")
             except Exception as e:
                 await message.reply_text(f"❌ Error! Make sure Bot is Admin in `{cid}`.\nDetails: {e}")
@@ -782,13 +2234,13 @@ async def settings_commands(client, message: Message):
                 target_id = str(chat_info.id)
             except:
                 target_id = cid
-            await users_collection.update_one({'_id': uid}, {'$pull': {'channel_ids': target_id}})
+            await update_user(uid, {'$pull': {'channel_ids': target_id}})
             await message.reply_text(f"✅ Channel removed.")
         else:
             await message.reply_text("❌ Usage: `/delchannel -100xxxx`")
 
     elif cmd == "mychannels":
-        data = await users_collection.find_one({'_id': uid})
+        data = await get_user(uid)
         channels = data.get('channel_ids',[])
         if channels:
             msg = await message.reply_text("🔄 Fetching your channels...")
@@ -807,12 +2259,21 @@ async def settings_commands(client, message: Message):
 # 7. AUTO POST (TMDB & IMDb SMART SEARCH) & TRENDING
 # ==============================================================================
 
+TMDB_BUSY_TEXT = "⏳ **TMDB is busy right now.**\nPlease try again in a few seconds."
+
 @bot.on_message(filters.command("trending") & filters.private)
 @force_subscribe
 @check_premium
 async def trending_cmd(client, message: Message):
-    msg = await message.reply_text("🔥 **Fetching Today's Trending Movies/Series...**")
-    results = await asyncio.to_thread(get_trending_today)
+    results = trending_snapshot["items"]
+    if results:
+        msg = await message.reply_text("🔥 **Loading Today's Trending Movies/Series...**")
+    else:
+        msg = await message.reply_text("🔥 **Fetching Today's Trending Movies/Series...**")
+        try:
+            results = await get_trending_today()
+        except RateLimitError:
+            return await msg.edit_text(TMDB_BUSY_TEXT)
     
     if not results:
         return await msg.edit_text("❌ **Could not fetch trending data right now.**")
@@ -840,8 +2301,17 @@ async def post_search_cmd(client, message: Message):
     
     results =[]
     
+    try:
+        if search_type == "tmdb":
+            details = await get_tmdb_details(m_type, extracted_val)
+        elif search_type == "imdb":
+            results = await search_by_imdb(extracted_val)
+        else:
+            results = await search_tmdb(extracted_val)
+    except RateLimitError:
+        return await msg.edit_text(TMDB_BUSY_TEXT)
+    
     if search_type == "tmdb":
-        details = await asyncio.to_thread(get_tmdb_details, m_type, extracted_val)
         if details:
             uid = message.from_user.id
             user_conversations[uid] = {
@@ -850,6 +2320,7 @@ async def post_search_cmd(client, message: Message):
                 "state": "wait_lang",
                 "is_manual": False
             }
+            start_poster_prefetch(uid, details)
             langs = [["English", "Hindi"],["Bengali", "Dual Audio"]]
             buttons = [[InlineKeyboardButton(l, callback_data=f"lang_{l}") for l in row] for row in langs]
             buttons.append([InlineKeyboardButton("✍️ Custom Language", callback_data="lang_custom")])
@@ -858,13 +2329,8 @@ async def post_search_cmd(client, message: Message):
         else:
             return await msg.edit_text("❌ Invalid TMDB Link.")
 
-    elif search_type == "imdb":
-        results = await asyncio.to_thread(search_by_imdb, extracted_val)
-        if not results:
-             return await msg.edit_text("❌ IMDb ID not found in TMDB database.")
-    
-    else:
-        results = await asyncio.to_thread(search_tmdb, extracted_val)
+    elif search_type == "imdb" and not results:
+        return await msg.edit_text("❌ IMDb ID not found in TMDB database.")
 
     if not results:
         return await msg.edit_text("❌ **No results found!**\nTry checking the spelling or use an IMDb link.")
@@ -912,7 +2378,10 @@ async def manual_type_handler(client, cb: CallbackQuery):
 @bot.on_callback_query(filters.regex("^sel_"))
 async def media_selected(client, cb: CallbackQuery):
     _, m_type, mid = cb.data.split("_")
-    details = await asyncio.to_thread(get_tmdb_details, m_type, mid)
+    try:
+        details = get_trending_details(m_type, mid) or await get_tmdb_details(m_type, mid)
+    except RateLimitError:
+        return await cb.answer("⏳ TMDB is busy right now. Try again in a few seconds.", show_alert=True)
     if not details: return await cb.answer("Error fetching details!", show_alert=True)
     
     uid = cb.from_user.id
@@ -922,6 +2391,7 @@ async def media_selected(client, cb: CallbackQuery):
         "state": "wait_lang",
         "is_manual": False
     }
+    start_poster_prefetch(uid, details)
     
     langs = [["English", "Hindi"],["Bengali", "Dual Audio"]]
     buttons = [[InlineKeyboardButton(l, callback_data=f"lang_{l}") for l in row] for row in langs]
@@ -990,6 +2460,7 @@ async def toggle_batch_handler(client, cb: CallbackQuery):
     if not convo: return await cb.answer("Session expired.", show_alert=True)
     
     if convo.get("is_batch_mode", False):
+        await file_buffer.flush()
         convo["is_batch_mode"] = False
         convo["batch_season_prefix"] = None 
         await cb.answer("🔴 Batch Mode Disabled.", show_alert=True)
@@ -1055,6 +2526,8 @@ async def badge_menu_handler(client, cb: CallbackQuery):
 async def back_button(client, cb: CallbackQuery):
     uid = cb.from_user.id
     if uid in user_conversations:
+        if user_conversations[uid].get("is_batch_mode"):
+            await file_buffer.flush()
         user_conversations[uid]["is_batch_mode"] = False
         user_conversations[uid]["batch_season_prefix"] = None
     await show_upload_panel(cb.message, uid, is_edit=True)
@@ -1098,7 +2571,8 @@ async def add_episode_cmd(client, message: Message):
         "state": "wait_file_for_edit",
         "edit_chat_id": chat_id,
         "edit_msg_id": msg_id,
-        "old_markup": target_msg.reply_markup
+        "old_markup": target_msg.reply_markup,
+        "post_caption": str(target_msg.caption or "")
     }
     
     await message.reply_text(
@@ -1166,7 +2640,7 @@ async def repost_handler(client, cb: CallbackQuery):
 # 11. MAIN MESSAGE HANDLER (TEXT & FILES)
 # ==============================================================================
 
-@bot.on_message(filters.private & (filters.text | filters.video | filters.document | filters.photo) & ~filters.command(["start", "post", "manual", "addep", "cancel", "trending", "settings", "backup", "setwatermark", "setapi", "setdomain", "settimer", "addchannel", "delchannel", "mychannels", "settutorial", "stats", "broadcast", "addpremium", "rempremium"]))
+@bot.on_message(filters.private & (filters.text | filters.video | filters.document | filters.photo) & ~filters.command(["start", "post", "manual", "addep", "cancel", "trending", "settings", "backup", "setwatermark", "setapi", "setdomain", "settimer", "addchannel", "delchannel", "mychannels", "settutorial", "stats", "broadcast", "addpremium", "rempremium", "health", "indexes", "restore"]))
 async def main_conversation_handler(client, message: Message):
     uid = message.from_user.id
     convo = user_conversations.get(uid)
@@ -1191,56 +2665,77 @@ async def main_conversation_handler(client, message: Message):
         msg = await message.reply_text("🔍 **আপনার মুভিটি আমাদের ডাটাবেসে খোঁজা হচ্ছে...**\n(দয়া করে অপেক্ষা করুন)")
         
         try:
-            tmdb_results = await asyncio.to_thread(search_tmdb, request_text)
+            try:
+                tmdb_results = await search_tmdb(request_text)
+            except RateLimitError:
+                tmdb_results = []
+            tmdb_match = None
             if tmdb_results:
                 corrected_title = tmdb_results[0].get('title') or tmdb_results[0].get('name')
+                if tmdb_results[0].get('id'):
+                    tmdb_match = {"tmdb_id": int(tmdb_results[0]['id']), "media_type": tmdb_results[0].get('media_type', 'movie')}
             else:
                 corrected_title = request_text
 
-            clean_name = re.sub(r'[^a-zA-Z0-9\s]', ' ', corrected_title)
-            words =[w for w in clean_name.split() if len(w) > 1][:4] 
-            if not words: words = request_text.split()[:4]
-            
-            regex_pattern = "".join([f"(?=.*{re.escape(w)})" for w in words])
-            query = {"caption": {"$regex": regex_pattern, "$options": "i"}}
-            
-            found_files = await files_collection.find(query).to_list(length=10)
+            # Longest tokens first: the title_tokens index walks the first $all term, usually the rarest
+            words = sorted(title_tokens(corrected_title) or title_tokens(request_text), key=len, reverse=True)[:4]
+            found_files = []
+            candidates = []
+            # Exact TMDB matches are fetched first and newest first, so a title with many files
+            # (e.g. season batches) never loses them to the candidate cap; title matches top up the rest
+            if tmdb_match:
+                candidates = await files_collection.find(tmdb_match).sort("created_at", -1).to_list(length=AUTO_REPLY_CANDIDATES)
+            if words and len(candidates) < AUTO_REPLY_CANDIDATES:
+                query = {"title_tokens": {"$all": words}}
+                if candidates:
+                    query["_id"] = {"$nin": [f["_id"] for f in candidates]}
+                candidates += await files_collection.find(query).sort("created_at", -1).to_list(length=AUTO_REPLY_CANDIDATES - len(candidates))
+            if candidates:
+                # Exact TMDB id first, then closest titles (fewest extra words), newest upload breaks ties
+                wanted = set(title_tokens(corrected_title))
+                candidates.sort(key=lambda f: (
+                    not (tmdb_match and f.get("tmdb_id") == tmdb_match["tmdb_id"] and f.get("media_type") == tmdb_match["media_type"]),
+                    len(set(f.get("title_tokens", [])) ^ wanted),
+                    -(f["created_at"].timestamp() if f.get("created_at") else 0)
+                ))
+                found_files = candidates[:10]
             
             if found_files:
                 buttons =[]
-                languages = set()
-                genres = set()
+                languages = {}
+                genres = {}
+                qualities = []
+                bot_uname = await get_bot_username()
+                fanout = asyncio.Semaphore(AUTO_REPLY_FANOUT)
                 
-                for f in found_files:
-                    caption_text = f.get('caption', '')
-                    
-                    qual_match = re.search(r"Quality:\*\*\s*(.*?)\n", caption_text)
-                    qual = qual_match.group(1).strip() if qual_match else "Download"
-                    
-                    lang_match = re.search(r"Language:\*\*\s*(.*?)\n", caption_text)
-                    if lang_match and lang_match.group(1).strip() not in ["Unknown", "N/A"]:
-                        languages.add(lang_match.group(1).strip())
-                        
-                    genre_match = re.search(r"Genre:\*\*\s*(.*?)\n", caption_text)
-                    if genre_match and genre_match.group(1).strip() not in ["Unknown", "N/A"]:
-                        genres.add(genre_match.group(1).strip())
-                    
-                    bot_uname = await get_bot_username()
+                async def build_link(f):
                     file_code = f['code']
-                    
                     if BLOG_URL and "http" in BLOG_URL:
                         base_blog = BLOG_URL.rstrip("/")
                         final_long_url = f"{base_blog}/?code={file_code}"
                     else:
                         final_long_url = f"https://t.me/{bot_uname}?start={file_code}"
                     
-                    uploader_id = f.get('uploader_id', uid) 
-                    short_link = await shorten_link(uploader_id, final_long_url)
-                    
+                    # A shortener that misses the budget gets the long URL (the call keeps running and is memoized)
+                    try:
+                        return await asyncio.wait_for(shorten_link(f.get('uploader_id', uid), final_long_url, fanout), AUTO_REPLY_LINK_DEADLINE)
+                    except asyncio.TimeoutError:
+                        return final_long_url
+                
+                link_jobs = asyncio.gather(*[build_link(f) for f in found_files])
+                
+                for f in found_files:
+                    qualities.append(f.get('quality') or "Download")
+                    if f.get('language'):
+                        languages[f['language']] = True
+                    for g in f.get('genres') or []:
+                        genres[g] = True
+                
+                for qual, short_link in zip(qualities, await link_jobs):
                     buttons.append([InlineKeyboardButton(f"📥 {qual}", url=short_link)])
                     
                 display_lang = ", ".join(languages) if languages else "Unknown"
-                display_genre = list(genres)[0] if genres else "Unknown"
+                display_genre = ", ".join(list(genres)[:3]) if genres else "Unknown"
                     
                 await msg.edit_text(
                     f"✅ **খুশির খবর!**\nআপনি যেই মুভিটি খুঁজছেন, তা আমাদের কাছে আগে থেকেই আপলোড করা আছে।\n\n"
@@ -1263,6 +2758,7 @@ async def main_conversation_handler(client, message: Message):
             "date": datetime.now()
         }
         await requests_collection.insert_one(req_entry)
+        await bump_stats(requests=1)
         
         if LOG_CHANNEL_ID:
             await client.send_message(
@@ -1290,7 +2786,7 @@ async def main_conversation_handler(client, message: Message):
     elif state == "admin_add_prem_wait":
         if uid != OWNER_ID: return
         try:
-            await users_collection.update_one({'_id': int(text)}, {'$set': {'is_premium': True}}, upsert=True)
+            await set_premium(int(text), True)
             await message.reply_text(f"✅ Premium Added to ID: `{text}`")
         except: await message.reply_text("❌ Invalid ID.")
         user_conversations.pop(uid, None)
@@ -1299,7 +2795,7 @@ async def main_conversation_handler(client, message: Message):
     elif state == "admin_rem_prem_wait":
         if uid != OWNER_ID: return
         try:
-            await users_collection.update_one({'_id': int(text)}, {'$set': {'is_premium': False}})
+            await set_premium(int(text), False)
             await message.reply_text(f"✅ Premium Removed from ID: `{text}`")
         except: await message.reply_text("❌ Invalid ID.")
         user_conversations.pop(uid, None)
@@ -1404,14 +2900,16 @@ async def main_conversation_handler(client, message: Message):
             backup_file_id = log_msg.video.file_id if log_msg.video else log_msg.document.file_id
             
             code = generate_random_code()
-            user_data = await users_collection.find_one({'_id': uid})
+            user_data = await get_user(uid)
             file_caption = f"🎬 **{button_name}**\n━━━━━━━━━━━━━━\n🤖 @{await get_bot_username()}"
             
             await files_collection.insert_one({
                 "code": code, "file_id": backup_file_id, "log_msg_id": log_msg.id,
                 "caption": file_caption, "delete_timer": user_data.get('delete_timer', 0),
-                "uploader_id": uid, "created_at": datetime.now()
+                "uploader_id": uid, "created_at": datetime.now(), "stored_at": datetime.now(),
+                **caption_metadata(convo.get("post_caption"), quality=button_name)
             })
+            await bump_stats(files=1)
             
             bot_uname = await get_bot_username()
             if BLOG_URL and "http" in BLOG_URL:
@@ -1508,16 +3006,21 @@ async def main_conversation_handler(client, message: Message):
             )
             
             code = generate_random_code()
-            user_data = await users_collection.find_one({'_id': uid})
+            user_data = await get_user(uid)
             
-            await files_collection.insert_one({
+            file_buffer.add({
                 "code": code, 
                 "file_id": backup_file_id, 
                 "log_msg_id": log_msg.id,
                 "caption": file_caption, 
                 "delete_timer": user_data.get('delete_timer', 0),
                 "uploader_id": uid, 
-                "created_at": datetime.now()
+                "created_at": datetime.now(),
+                **file_metadata(
+                    title, year, btn_name, lang,
+                    [g["name"] if isinstance(g, dict) else str(g) for g in details.get("genres") or []],
+                    details.get("id"), details.get("media_type")
+                )
             })
             
             bot_uname = await get_bot_username()
@@ -1558,6 +3061,9 @@ async def process_final_post(client, cb: CallbackQuery):
     
     if not convo: return await cb.answer("Session expired.", show_alert=True)
     if not convo['links']: return await cb.answer("❌ No files uploaded!", show_alert=True)
+    # Never publish links whose file records exist only in memory
+    if not await file_buffer.flush() and file_buffer.has_pending(uid):
+        return await cb.answer("⚠️ Your files could not be saved to the database yet. Please try FINISH again in a minute.", show_alert=True)
         
     await cb.message.edit_text("🖼️ **Generating Post... Please wait...**")
     
@@ -1565,10 +3071,13 @@ async def process_final_post(client, cb: CallbackQuery):
     m_type = details.get('media_type', 'movie')
     m_id = details.get('id')
     
-    # Auto fetch Trailer URL using Async Thread
+    # Trailer comes embedded in the details response (append_to_response=videos)
     trailer_url = None
     if m_id and not convo.get('is_manual'):
-        trailer_url = await asyncio.to_thread(get_tmdb_trailer, m_type, m_id)
+        if "videos" in details:
+            trailer_url = extract_trailer(details["videos"])
+        else:
+            trailer_url = await get_tmdb_trailer(m_type, m_id)
     
     caption = await generate_channel_caption(
         convo['details'], convo.get('language', 'Unknown'), convo['links'], 
@@ -1611,30 +3120,45 @@ async def process_final_post(client, cb: CallbackQuery):
     
     if temp_row: buttons.append(temp_row)
         
-    user_data = await users_collection.find_one({'_id': uid})
+    user_data = await get_user(uid)
     if user_data.get('tutorial_url'):
         buttons.append([InlineKeyboardButton("ℹ️ How to Download", url=user_data['tutorial_url'])])
     
-    poster_input = None
+    poster_source = None
     if details.get('poster_local_path') and os.path.exists(details['poster_local_path']):
-        poster_input = details['poster_local_path']
+        poster_source = details['poster_local_path']
     elif details.get('poster_path'):
-        poster_input = f"https://image.tmdb.org/t/p/w500{details['poster_path']}"
-        
-    # Process Image with Asyncio to prevent lag
-    poster_buffer, error = await asyncio.to_thread(
-        watermark_poster, poster_input, user_data.get('watermark_text'), convo.get('temp_badge_text')
-    )
+        poster_source = tmdb_poster_url(details)
+    if not poster_source: return await cb.message.edit_text("❌ Image Error: Poster not found.")
     
-    if not poster_buffer: return await cb.message.edit_text(f"❌ Image Error: {error}")
+    watermark_text = user_data.get('watermark_text')
+    badge_text = convo.get('temp_badge_text')
+    render_key = await asyncio.to_thread(render_cache.make_key, poster_source, watermark_text, badge_text)
     
-    poster_buffer.seek(0)
-    try:
-        preview_msg = await client.send_photo(
-            chat_id=uid, photo=poster_buffer, caption=caption, reply_markup=InlineKeyboardMarkup(buttons)
-        )
-    except Exception as e:
-        return await cb.message.edit_text(f"❌ Failed to send preview: {e}")
+    # Same poster + watermark + badge posted before: reuse Telegram's copy (no render, no upload)
+    preview_msg = None
+    cached_file_id = render_cache.get_file_id(render_key)
+    if cached_file_id:
+        try:
+            preview_msg = await client.send_photo(
+                chat_id=uid, photo=cached_file_id, caption=caption, reply_markup=InlineKeyboardMarkup(buttons)
+            )
+        except Exception as e:
+            logger.warning(f"Cached Poster Send Error: {e}")
+            preview_msg = None
+    
+    if not preview_msg:
+        poster_buffer, error = await render_poster(poster_source, watermark_text, badge_text, render_key)
+        if not poster_buffer: return await cb.message.edit_text(f"❌ Image Error: {error}")
+        
+        poster_buffer.seek(0)
+        try:
+            preview_msg = await client.send_photo(
+                chat_id=uid, photo=poster_buffer, caption=caption, reply_markup=InlineKeyboardMarkup(buttons)
+            )
+        except Exception as e:
+            return await cb.message.edit_text(f"❌ Failed to send preview: {e}")
+        render_cache.set_file_id(render_key, preview_msg.photo.file_id)
 
     await cb.message.delete()
     
@@ -1693,6 +3217,33 @@ async def close_post_handler(client, cb: CallbackQuery):
     await cb.message.delete()
     await cb.answer("✅ Session Closed.", show_alert=True)
 
+async def main():
+    await ensure_indexes()
+    spooled = file_buffer.load_spool()
+    if spooled:
+        logger.info(f"Replaying {spooled} spooled file records")
+    await bot.start()
+    logger.info("✅ Bot Started!")
+    background_tasks = [
+        asyncio.create_task(trending_refresher()),
+        asyncio.create_task(run_migrations()),
+        asyncio.create_task(stats_reconciler()),
+        asyncio.create_task(file_buffer.run()),
+    ]
+    try:
+        await idle()
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await bot.stop()
+        await file_buffer.close()
+        await close_http_session()
+        render_engine.shutdown()
+
 if __name__ == "__main__":
+    # Render workers are forked before the Flask/pyrogram threads exist, with assets already on disk
+    warm_render_assets()
+    render_engine.start(fork=True)
+    Thread(target=run_flask, daemon=True).start()
     logger.info("🚀 Bot is starting...")
-    bot.run()
+    bot.run(main())